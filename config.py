@@ -23,6 +23,12 @@ try:
     from secret import APNS_CERT
 except ImportError:
     APNS_CERT = 'sandbox'
+# Let nginx send gametype images itself (via X-Accel-Redirect);
+# requires internal /_images/ location, see README
+try:
+    from secret import NGINX_IMAGES
+except ImportError:
+    NGINX_IMAGES = False
 from secret import ADMIN_IDS
 from secret import RIOT_KEY, STEAM_KEY, BATTLENET_KEY, SC2RANKS_KEY
 from secret import DATADOG_API_KEY
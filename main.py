@@ -19,6 +19,10 @@ app.config['SQLALCHEMY_DATABASE_URI'] = config.DB_URL
 app.config['ERROR_404_HELP'] = False # disable this flask_restful feature
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024 # limit upload size for userpics
 app.config['SECRET_KEY'] = config.SECRET_KEY
+# compact json output: no indentation for jsonify responses
+# and no spaces after separators for restful ones
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+app.config['RESTFUL_JSON'] = {'separators': (',', ':')}
 
 datadog.initialize(api_key=config.DATADOG_API_KEY)
 
@@ -122,6 +126,21 @@ if __name__ == '__main__':
             db.session.add(player.badges)
             db.session.commit()
 
+    @manager.command
+    def sync_upload_flags():
+        """Set has_userpic/has_message columns according to uploaded files.
+        Run after applying migration which introduced these columns.
+        """
+        from v1.models import Player, Game
+        from v1.routes import UserpicResource, GameMessageResource
+
+        for model, resource in ((Player, UserpicResource),
+                                (Game, GameMessageResource)):
+            for entity in model.query:
+                setattr(entity, resource.FLAG,
+                        bool(resource.findfile(entity)))
+            db.session.commit()
+
     @manager.command
     def update_badges():
         """This command will add new badges for every player.
@@ -2,18 +2,94 @@ from flask import request
 
 import os
 import time
+import threading
+import pickle
 from datetime import datetime, timedelta
 from collections import OrderedDict, namedtuple
+from functools import wraps, lru_cache
 import email
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests_oauthlib import OAuth1Session
 
 try:
     import config
     from .helpers import log
+    from .main import redis
 except ImportError:
     # test environment
     from .mock import config, log
+    redis = None
+
+
+# Shared session, so that connections to apis are kept alive and reused
+# instead of doing TCP+TLS handshake for each request.
+# Failed connections are retried for idempotent methods.
+http_session = requests.Session()
+for prefix in 'http://', 'https://':
+    http_session.mount(prefix, HTTPAdapter(
+        pool_connections=32, pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    ))
+del prefix
+
+def _cache_key(*parts):
+    return '{}.apicache.{}'.format(
+        'test' if config.TEST else 'prod',
+        ':'.join(map(str, parts)),
+    )
+
+def _is_empty(ret):
+    """
+    Default check for results which should not be cached:
+    falsy ones, api replies with `_code` other than 200,
+    and tuples of Nones (like `(None, None)` meaning "not found").
+    """
+    if not ret:
+        return True
+    if isinstance(ret, dict):
+        return ret.get('_code', 200) != 200
+    if isinstance(ret, tuple):
+        return all(item is None for item in ret)
+    return False
+
+def redis_cached(ttl, is_empty=_is_empty):
+    """
+    Decorator which caches function's results in Redis for `ttl` timedelta,
+    so that they are shared between processes and polling cycles.
+    Key is built from function name and arguments.
+    Results for which `is_empty(result)` is true are not cached,
+    so that failures and negative lookups are retried next time.
+    If Redis is not available, function is just called.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not redis:
+                return func(*args, **kwargs)
+            key = _cache_key(
+                func.__module__, func.__qualname__,
+                args, sorted(kwargs.items()),
+            )
+            try:
+                data = redis.get(key)
+            except Exception:
+                log.exception('Failed to get cached api result')
+                data = None
+            if data is not None:
+                return pickle.loads(data)
+
+            ret = func(*args, **kwargs)
+            if not is_empty(ret):
+                try:
+                    redis.set(key, pickle.dumps(ret),
+                              ex=int(ttl.total_seconds()))
+                except Exception:
+                    log.exception('Failed to cache api result')
+            return ret
+        return wrapper
+    return decorator
 
 ### External APIs ###
 def nexmo(endpoint, **kwargs):
@@ -86,7 +162,7 @@ class PayPal:
         if cls.token_ttl and cls.token_ttl <= datetime.utcnow():
             cls.token = None # expired
         if not cls.token:
-            ret = requests.post(
+            ret = http_session.post(
                 cls.base_url+'oauth2/token',
                 data={'grant_type': 'client_credentials'},
                 auth=(config.PAYPAL_CLIENT, config.PAYPAL_SECRET),
@@ -96,10 +172,10 @@ class PayPal:
                 return
             ret = ret.json()
             cls.token = ret['access_token']
-            cls.token_lifetime = (datetime.utcnow() +
-                                  timedelta(seconds =
-                                            # -10sec to be sure
-                                            ret['expires_in'] - 10))
+            cls.token_ttl = (datetime.utcnow() +
+                             timedelta(seconds =
+                                       # -10sec to be sure
+                                       ret['expires_in'] - 10))
         return cls.token
     @classmethod
     def call(cls, method, url, params=None, json=None):
@@ -111,11 +187,11 @@ class PayPal:
             'Authorization': 'Bearer '+cls.get_token(),
             #TODO: 'PayPal-Request-Id': None, # use generated nonce
         }
-        ret = requests.request(method, url,
-                            params=params,
-                            json=json,
-                            headers = headers,
-                            )
+        ret = http_session.request(method, url,
+                                   params=params,
+                                   json=json,
+                                   headers = headers,
+                                   )
         log.debug('Paypal result: {} {}'.format(ret.status_code, ret.text))
         try:
             jret = ret.json()
@@ -127,35 +203,47 @@ class PayPal:
         return jret
 
 class Fixer:
-    # fixer rates are updated daily, but it should be enough for us
-    item = namedtuple('item', ['ttl','rate'])
+    # fixer rates are updated daily, but it should be enough for us.
+    # Whole rate table is cached per base currency,
+    # so that lookups for other currencies don't need requests.
+    item = namedtuple('item', ['ttl','rates'])
     cache = OrderedDict()
     cache_max = 100
-    cache_ttl = timedelta(minutes=15)
+    cache_ttl = timedelta(hours=1)
     @classmethod
-    def latest(cls, src, dst):
-        if src == dst:
-            return 1
-
+    def rates(cls, src):
+        """
+        Returns dict of rates for given base currency, or None on failure.
+        """
         now = datetime.now()
-        if (src,dst) in cls.cache:
-            cls.cache.move_to_end((src,dst))
-            if cls.cache[(src,dst)].ttl > now:
-                return cls.cache[(src,dst)].rate
+        if src in cls.cache:
+            cls.cache.move_to_end(src)
+            if cls.cache[src].ttl > now:
+                return cls.cache[src].rates
 
-        result = requests.get('http://api.fixer.io/latest', params={
-            'base': src, 'symbols': dst}).json()
+        result = http_session.get('http://api.fixer.io/latest', params={
+            'base': src}).json()
         if 'rates' not in result:
             log.warning('Failure with Fixer api: '+str(result))
             return None
-        rate = result.get('rates').get(dst)
-        if rate is None:
-            raise ValueError('Unknown currency '+dst)
+        rates = result['rates']
 
-        cls.cache[(src,dst)] = cls.item(now+cls.cache_ttl, rate)
+        cls.cache[src] = cls.item(now+cls.cache_ttl, rates)
         if len(cls.cache) > cls.cache_max:
             cls.cache.popitem(last=False)
 
+        return rates
+    @classmethod
+    def latest(cls, src, dst):
+        if src == dst:
+            return 1
+
+        rates = cls.rates(src)
+        if rates is None:
+            return None
+        rate = rates.get(dst)
+        if rate is None:
+            raise ValueError('Unknown currency '+dst)
         return rate
 
 def mailsend(user, mtype, sender=None, delayed=None, usebase=True, **kwargs):
@@ -245,7 +333,7 @@ class JsonApi:
     @classmethod
     def session(cls):
         " If overriden, should return a requests.session object "
-        return requests
+        return http_session
     @classmethod
     def request(cls, *args, **kwargs):
         " Can be overriden "
@@ -267,28 +355,72 @@ class JsonApi:
 
         return resp
 
+    # how long to remember validators for conditional requests
+    CONDITIONAL_TTL = timedelta(days=1)
+    @classmethod
+    def request_conditional(cls, url, parse, **kwargs):
+        """
+        Performs GET request and returns `parse(response)`.
+        Result is remembered in Redis along with response's ETag and
+        Last-Modified headers, which are sent back with the next request
+        for the same url; if server replies with 304 Not Modified,
+        remembered result is returned without parsing anything.
+        """
+        if not redis:
+            return parse(cls.request('GET', url, **kwargs))
+        key = _cache_key('conditional', url,
+                         sorted(kwargs.get('params', {}).items()))
+        try:
+            data = redis.get(key)
+        except Exception:
+            log.exception('Failed to get conditional request data')
+            data = None
+        etag, modified, result = pickle.loads(data) if data else (None,)*3
+
+        headers = kwargs.setdefault('headers', {})
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+        ret = cls.request('GET', url, **kwargs)
+        if ret.status_code == 304 and data:
+            return result
+
+        result = parse(ret)
+        etag = ret.headers.get('ETag')
+        modified = ret.headers.get('Last-Modified')
+        if ret.status_code == 200 and (etag or modified):
+            try:
+                redis.set(key, pickle.dumps((etag, modified, result)),
+                          ex=int(cls.CONDITIONAL_TTL.total_seconds()))
+            except Exception:
+                log.exception('Failed to save conditional request data')
+        return result
+
 class LimitedApi(JsonApi):
     # this is default delay between subsequent requests to the same api,
     # can be overriden in subclasses
     DELAY = timedelta(seconds=2)
+    # guards _last, as api may be used from several polling threads
+    _lock = threading.Lock()
 
     @classmethod
     def request(cls, *args, **kwargs):
         """
         This overrides JsonApi's method adding delay.
         """
-        # TODO: maybe use session for delaying?
-        now = datetime.utcnow()
-        last = getattr(cls, '_last', None)
-        if last:
-            diff = now - last
-            delay = cls.DELAY - diff
-            seconds = delay.total_seconds()
-            if seconds > 0:
-                time.sleep(seconds)
-        # and before we actually call the method, save current time
+        # Reserve time slot for our request under lock,
+        # and then sleep till that time without holding it.
+        # We save planned request time as the last one
         # (so that api's internal delay will count as a part of our delay)
-        cls._last = datetime.utcnow()
+        with cls._lock:
+            now = datetime.utcnow()
+            last = getattr(cls, '_last', None)
+            start = max(now, last + cls.DELAY) if last else now
+            cls._last = start
+        seconds = (start - now).total_seconds()
+        if seconds > 0:
+            time.sleep(seconds)
 
         # now that we slept if needed, call Requests
         # and handle any json-related problems
@@ -303,6 +435,7 @@ class Riot(LimitedApi):
     ]
 
     @classmethod
+    @redis_cached(timedelta(days=1))
     def summoner_check(cls, val, region = None):
         """
         Summoner name can be either full (with region) or short.
@@ -336,6 +469,7 @@ class Riot(LimitedApi):
         raise ValueError('Unknown summoner name')
 
     @classmethod
+    @redis_cached(timedelta(minutes=5))
     def call(cls, region, version, method, params=None, data=None):
         if region not in cls.REGIONS:
             raise ValueError('Unknown region %s' % region)
@@ -366,6 +500,7 @@ class Steam(LimitedApi):
             val -= cls.STEAM_ID_64_BASE
         return val
     @classmethod
+    @lru_cache(maxsize=4096)
     def id_to_64(cls, val):
         if val < cls.STEAM_ID_64_BASE:
             val += cls.STEAM_ID_64_BASE
@@ -456,6 +591,7 @@ class Steam(LimitedApi):
                 return ret[wrapper]
         return ret
     @classmethod
+    @redis_cached(timedelta(minutes=5))
     def dota2(cls, method, match=True, **params):
         # docs available at https://wiki.teamfortress.com/wiki/WebAPI#Dota_2
         return cls.call('IDOTA2{}_570'.format('Match' if match else ''),
@@ -521,6 +657,7 @@ class StarCraft(BattleNet):
         int(ureg)
         return '/'.join([region, uid, ureg, uname])
     @classmethod
+    @redis_cached(timedelta(minutes=5))
     def profile(cls, user, part=''):
         region, uid, ureg, uname = user.split('/')
         return cls.call(
@@ -22,3 +22,18 @@ class classproperty:
         return self.obj[cls]
 
 
+def with_app_context(func):
+    """
+    Wraps given function so that it will run within current app's context.
+    Useful for functions to be called in other threads.
+    If there is no current app, returns function as is.
+    """
+    try:
+        app = current_app._get_current_object()
+    except RuntimeError:  # working outside of application context
+        return func
+
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return func(*args, **kwargs)
+    return wrapper
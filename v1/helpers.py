@@ -15,6 +15,10 @@ import json
 import requests
 from functools import wraps
 import binascii
+import queue
+import threading
+import atexit
+import time
 import apns_clerk
 import datadog as datadog_api
 from eventlet.timeout import Timeout
@@ -24,10 +28,40 @@ from .models import *
 from .main import db, redis
 from .common import *
 
+# Events are sent to datadog from background thread
+# so that requests don't wait for datadog api.
+_datadog_queue = queue.Queue(maxsize=10000)
+_datadog_thread = None
+_datadog_lock = threading.Lock()
+def _datadog_sender():
+    while True:
+        event = _datadog_queue.get()
+        try:
+            datadog_api.api.Event.create(**event)
+        except:
+            log.exception('Datadog failure')
+        finally:
+            _datadog_queue.task_done()
+
+def _datadog_flush(timeout=10):
+    """
+    Waits (at most `timeout` seconds) for queued events to be sent,
+    as daemon sender thread is killed on exit.
+    Important for short-living processes like poll.py.
+    """
+    deadline = time.monotonic() + timeout
+    with _datadog_queue.all_tasks_done:
+        while _datadog_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _datadog_queue.all_tasks_done.wait(remaining)
+
 def datadog(title, text=None, _log=True, **tags):
     """
     Call log.info and send event to datadog
     """
+    global _datadog_thread
     if not current_app.debug:
         try:
             if _log:
@@ -39,11 +73,22 @@ def datadog(title, text=None, _log=True, **tags):
                 tags.setdefault('user.id', g.user.id)
                 tags.setdefault('user.nickname', g.user.nickname)
                 tags.setdefault('user.email', g.user.email)
-            datadog_api.api.Event.create(
+            with _datadog_lock:
+                if not _datadog_thread:
+                    # sender logs failures via current_app,
+                    # so it needs app context of its own
+                    _datadog_thread = threading.Thread(
+                        target=with_app_context(_datadog_sender),
+                        daemon=True)
+                    _datadog_thread.start()
+                    atexit.register(_datadog_flush)
+            _datadog_queue.put_nowait(dict(
                 title=title,
                 text=text,
                 tags=[':'.join(map(str, item)) for item in tags.items()],
-            )
+            ))
+        except queue.Full:
+            log.warning('Datadog queue is full, dropping event: '+title)
         except:
             log.exception('Datadog failure')
 dd_stat = datadog_api.statsd
@@ -91,10 +136,11 @@ def validateFederatedToken(service, refresh_token):
                             data = params).json()
         success = 'access_token' in ret
     elif service == 'facebook':
-        ret = requests.get('https://graph.facebook.com/me/permissions',
-                           params = dict(
-                               access_token = refresh_token,
-                           )).json()
+        from .apis import http_session
+        ret = http_session.get('https://graph.facebook.com/me/permissions',
+                               params = dict(
+                                   access_token = refresh_token,
+                               )).json()
         success = 'data' in ret
     else:
         raise ValueError('Bad service '+service)
@@ -127,13 +173,14 @@ def federatedExchangeGoogle(code):
                 (ret.status_code, jret.get('error', ret.reason),
                 jret.get('error_description', 'no details')))
 def federatedRenewFacebook(refresh_token):
-    ret = requests.get('https://graph.facebook.com/oauth/access_token',
-                       params=dict(
-                           grant_type='fb_exchange_token',
-                           client_id=config.FACEBOOK_AUTH_CLIENT_ID,
-                           client_secret=config.FACEBOOK_AUTH_CLIENT_SECRET,
-                           fb_exchange_token=refresh_token,
-                       ))
+    from .apis import http_session
+    ret = http_session.get('https://graph.facebook.com/oauth/access_token',
+                           params=dict(
+                               grant_type='fb_exchange_token',
+                               client_id=config.FACEBOOK_AUTH_CLIENT_ID,
+                               client_secret=config.FACEBOOK_AUTH_CLIENT_SECRET,
+                               fb_exchange_token=refresh_token,
+                           ))
     # result is in urlencoded form, so convert it to dict
     jret = dict(urllib.parse.parse_qsl(ret.text))
     if 'access_token' in jret:
@@ -464,6 +511,20 @@ def string_field(field, ftype=None, check_unique=True, allow_empty=False):
         return val
     return check
 
+def unchanged_field(name, ftype=None):
+    """
+    This decorator-like function wraps given field type
+    so that value equal to current user's `name` attribute
+    is accepted as is, skipping checks and conversions
+    (which may involve queries or external api calls).
+    """
+    def check(val):
+        user = getattr(g, 'user', None)
+        if user and val == getattr(user, name, None):
+            return val
+        return ftype(val) if ftype else val
+    return check
+
 def bitmask_field(options):
     '''
     Converts comma-separated list of options to bitmask.
@@ -570,6 +631,28 @@ class JsonField(restful.fields.Raw):
             log.warning('Bad json field data')
             return val
 
+def order_choices(*names):
+    """
+    Returns set of allowed values for `order` argument:
+    each of given names, ascending or descending (with '-' prefix).
+    """
+    return frozenset(
+        prefix + name
+        for name in names
+        for prefix in ('', '-')
+    )
+
+def field_instances(fieldset):
+    """
+    Returns copy of given fields dict with field classes instantiated.
+    marshal instantiates field classes for every object it formats,
+    so prebuilt fieldsets should be passed through this.
+    """
+    return {
+        name: field() if isinstance(field, type) else field
+        for name, field in fieldset.items()
+    }
+
 
 # Notification
 apns_session = None
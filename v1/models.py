@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
+import math
 
-from sqlalchemy import or_, case, and_
+from sqlalchemy import or_, case, and_, event
 from sqlalchemy.orm import deferred, undefer_group, undefer, attributes
 from sqlalchemy.sql.expression import func
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
@@ -40,6 +41,10 @@ class Player(db.Model):
 
     balance = db.Column(db.Float, default=0)
     locked = db.Column(db.Float, default=0)
+
+    # maintained by UserpicResource
+    has_userpic = db.Column(db.Boolean, nullable=False,
+                            default=False, server_default='0')
     
     def __init__(self):
         self.badges = Badges()
@@ -70,6 +75,22 @@ class Player(db.Model):
             (Game.creator_id == self.id) |  # OR
             (Game.opponent_id == self.id))
 
+    def _games_union(self, *filters, each=None):
+        """
+        Same games as `games` but fetched as UNION ALL of creator's and
+        opponent's ones, so that each part can use its own index
+        instead of OR condition.
+        If `each` is given, it is applied to both parts' queries
+        (e.g. to order and limit them separately).
+        """
+        crea, oppo = [
+            Game.query.filter(field == self.id, *filters)
+            for field in (Game.creator_id, Game.opponent_id)
+        ]
+        if each:
+            crea, oppo = each(crea), each(oppo)
+        return crea.union_all(oppo)
+
     @hybrid_method
     def gamecount_impl(self, *filters):
         return fast_count(self.games.filter(*filters))
@@ -91,7 +112,7 @@ class Player(db.Model):
     def winrate_impl(self, *filters):
         count = 0
         wins = 0
-        for game in self.games.filter(Game.state == 'finished', *filters):
+        for game in self._games_union(Game.state == 'finished', *filters):
             count += 1
             whoami = 'creator' if game.creator_id == self.id else 'opponent'
             if game.winner == 'draw':
@@ -148,7 +169,7 @@ class Player(db.Model):
                     (Game.creator_id == cls.id) |
                     (Game.opponent_id == cls.id)
                 ) &
-                Game.winner == 'draw',
+                (Game.winner == 'draw'),
             )
             .label('draw')
         )
@@ -190,7 +211,7 @@ class Player(db.Model):
                     (Game.creator_id == cls.id) |
                     (Game.opponent_id == cls.id)
                 ) &
-                Game.winner == 'draw',
+                (Game.winner == 'draw'),
             )
             .label('draw')
         )
@@ -217,31 +238,38 @@ class Player(db.Model):
         # 30.5 is approximate number of days in month
         delta = timedelta(days=1 if days else 7 if weeks else 30.5)
         now = datetime.utcnow()
-        ret = []
-        for i in range(count):
-            prev = now - delta
-
-            count, wins = 0, 0
-            for game in self.games.filter(
-                            Game.state == 'finished',
-                            Game.finish_date > prev,
-                            Game.finish_date <= now,
-            ):
-                count += 1
-                whoami = 'creator' if game.creator_id == self.id else 'opponent'
-                if game.winner == 'draw':
-                    wins += 0.5
-                elif game.winner == whoami:
-                    wins += 1
-            rate = (wins / count) if count else 0
-
-            ret.append((prev, count, wins, rate))
-            now = prev
-        return ret
+        # load all games of the whole range with one query
+        # and distribute them between intervals here;
+        # interval i covers (now - (i+1)*delta, now - i*delta]
+        counts = [0] * count
+        wins = [0.0] * count
+        for game in self._games_union(
+            Game.state == 'finished',
+            Game.finish_date > now - delta * count,
+            Game.finish_date <= now,
+        ):
+            i = max(math.ceil((now - game.finish_date) / delta) - 1, 0)
+            if i >= count:  # rounding at the edge
+                continue
+            counts[i] += 1
+            whoami = 'creator' if game.creator_id == self.id else 'opponent'
+            if game.winner == 'draw':
+                wins[i] += 0.5
+            elif game.winner == whoami:
+                wins[i] += 1
+        return [
+            (now - delta * (i + 1), counts[i], wins[i],
+             (wins[i] / counts[i]) if counts[i] else 0.0)
+            for i in range(count)
+        ]
 
     @hybrid_property
     def lastbet(self):
-        return self.games.order_by(Game.create_date.desc()).first().create_date
+        latest = Game.create_date.desc()
+        game = self._games_union(
+            each=lambda q: q.order_by(latest).limit(1),
+        ).order_by(latest).first()
+        return game.create_date if game else None
 
     @lastbet.expression
     def lastbet(cls):
@@ -286,22 +314,60 @@ class Player(db.Model):
     def popularity(self):
         return self.popularity_impl()  # without filters
 
+    @classmethod
+    def stats_for(cls, ids, *filters):
+        """
+        Returns {player id: (gamecount, winrate)} for given player ids
+        using one grouped query.
+        Gamecount counts all games like `gamecount` does,
+        and winrate is calculated like `winrate_impl(*filters)`.
+        Players without games are omitted.
+        """
+        if not ids:
+            return {}
+        counted = db.and_(Game.state == 'finished', *filters)
+        won = case([
+            (counted & (
+                ((Game.creator_id == cls.id) & (Game.winner == 'creator')) |
+                ((Game.opponent_id == cls.id) & (Game.winner == 'opponent'))
+            ), 1),
+            (counted & (Game.winner == 'draw'), 0.5),
+        ], else_=0)
+        return {
+            pid: (gamecount, float(wins) / finished if finished else None)
+            for pid, gamecount, finished, wins in
+            db.session.query(
+                cls.id,
+                func.count(Game.id),
+                func.sum(case([(counted, 1)], else_=0)),
+                func.sum(won),
+            )
+            .join(Game, (Game.creator_id == cls.id) |  # OR
+                        (Game.opponent_id == cls.id))
+            .filter(cls.id.in_(ids))
+            .group_by(cls.id)
+        }
+
     _leadercache = {}  # is a class field
     _leadercachetime = None
 
-    @property
-    def leaderposition(self):
-        if not self._leadercache or self._leadercachetime < datetime.utcnow():
-            self._leadercachetime = datetime.utcnow() + \
-                                    timedelta(minutes=5)
-            self._leadercache = {}
+    @classmethod
+    def leaderpositions(cls):
+        """
+        Returns mapping of player id to their leaderboard position.
+        Ranking the whole table is expensive, so it is computed
+        at most once per 5 minutes and shared by all players.
+        """
+        # store on the class explicitly, as assigning via self
+        # would create instance attributes and recompute it for each player
+        if not Player._leadercache or Player._leadercachetime < datetime.utcnow():
+            Player._leadercachetime = datetime.utcnow() + \
+                                      timedelta(minutes=5)
             # This is dirty way, but "db-related" one did not work..
             # http://stackoverflow.com/questions/7057772/get-row-position-in-mysql-query
             # MySQL kept ordering line numbers according to ID,
             # regardless of ORDER BY clause.
             # Maybe because of joins or so.
-
-            # TODO: maybe cache result in memory for e.g. 5min
             q = Player.query.with_entities(
                 Player.id,
             ).order_by(
@@ -310,34 +376,36 @@ class Player(db.Model):
                 Player.gamecount.desc(),
                 Player.id.desc(),
             )
-            self._leadercache = {
+            Player._leadercache = {
                 row[0]: n + 1
                 for n, row in enumerate(q)
             }
-        return self._leadercache[self.id]
+        return Player._leadercache
+
+    @property
+    def leaderposition(self):
+        # players registered after last refresh are not ranked yet
+        return self.leaderpositions().get(self.id)
 
     @hybrid_property
     def recent_opponents(self):
-        # last 5 sent and 5 received
+        # last 5 sent and 5 received.
+        # Ids are fetched first, because MySQL executes IN (subquery)
+        # as dependent subquery, i.e. once for each player in table.
         sent, recv = [
             Game.query.filter(field == self.id)
                 .order_by(Game.create_date.desc())
-                .limit(5).with_entities(other).subquery()
+                .limit(5).with_entities(other.label('id')).subquery()
             for field, other in [
                 (Game.creator_id, Game.opponent_id),
                 (Game.opponent_id, Game.creator_id),
             ]
         ]
-        return Player.query.filter(or_(
-            Player.id.in_(db.session.query(sent.c.opponent_id)),
-            Player.id.in_(db.session.query(recv.c.creator_id)),
-        ))
-
-    @property
-    def has_userpic(self):
-        from .routes import UserpicResource
-
-        return bool(UserpicResource.findfile(self))
+        ids = {
+            pid for pid, in
+            db.session.query(sent.c.id).union_all(db.session.query(recv.c.id))
+        }
+        return Player.query.filter(Player.id.in_(ids))
 
     _identities = [
         'nickname',
@@ -375,6 +443,25 @@ class Player(db.Model):
             p = cls.query.filter_by(**{identity: key}).first()
         return p
 
+    def matches(self, key):
+        """
+        Checks whether `find(key)` would return this very player.
+        Keys referring to this player by id, email or nickname
+        are recognized without querying database.
+        """
+        if key != '_':
+            if key.lower() == 'me':
+                return getattr(g, 'user', None) == self
+            if key == str(self.id):
+                return True
+            if '@' in key and '.' in key:
+                if key == self.email:
+                    return True
+            elif not key.isdigit() and key == self.nickname:
+                # nickname is the first identity checked by find
+                return True
+        return self.find(key) == self
+
     @classmethod
     def find_or_fail(cls, key):
         player = cls.find(key)
@@ -608,15 +695,26 @@ class Tournament(db.Model):
         self.payin = payin
         self.payout = payin * self.participants_cap
 
-    def create_participant(self, player: Player):
-        if self.participants_count >= self.participants_cap:
-            return None
-        participant = Participant(player.id, self.id)
-        if not self.participants:
-            participant.order = 0
-        else:
-            participant.order = self.participants[-1].order + 1
-        return participant
+    def insert_participant(self, player: Player):
+        """
+        Atomically adds participant if tournament is not full yet,
+        assigning him next order number.
+        Returns True if participant was added.
+        """
+        table = Participant.__table__
+        result = db.session.execute(
+            table.insert().from_select(
+                ['player_id', 'tournament_id', 'order'],
+                db.select([
+                    db.literal(player.id),
+                    db.literal(self.id),
+                    func.coalesce(func.max(table.c.order), -1) + 1,
+                ])
+                .where(table.c.tournament_id == self.id)
+                .having(func.count() < self.participants_cap)
+            )
+        )
+        return result.rowcount > 0
 
     def add_player(self, player: Player):
         if self.aborted:
@@ -628,10 +726,8 @@ class Tournament(db.Model):
         if player.available < self.payin:
             return False, 'You don\'t have enough coins', 'coins'
 
-        participant = self.create_participant(player)
-        if participant:
+        if self.insert_participant(player):
             player.locked += self.payin
-            db.session.add(participant)
             db.session.commit()
             return True, 'Success', None
         else:
@@ -667,10 +763,13 @@ class Tournament(db.Model):
         db.session.commit()
 
     def check_winner(self):
-        maybe_winner = None
-        for participant in self.participants:
-            if not maybe_winner or maybe_winner.round < participant.round:
-                maybe_winner = participant
+        # participant with the highest round, first by order on tie
+        maybe_winner = Participant.query.filter_by(
+            tournament_id=self.id,
+        ).order_by(
+            Participant.round.desc(),
+            Participant.order,
+        ).first()
         if maybe_winner and maybe_winner.round > self.rounds_count:
             self.set_winner(maybe_winner)
             return True
@@ -714,7 +813,14 @@ class Tournament(db.Model):
 
     def get_opponent(self, player: Player):
         self.check_state()
-        current_participant = Participant.query.get((player.id, self.id))
+        # check_state's commit expires participants, so they are reloaded
+        # here; the same collection is then reused by current_opponents_by_id
+        current_participant = next(
+            (p for p in self.participants if p.player_id == player.id),
+            None,
+        )
+        if not current_participant:
+            return None, 'You are not participating in this tournament'
         if current_participant.defeated or current_participant.round < self.current_round:
             return None, 'You were defeated'
         if current_participant.round > self.current_round:
@@ -749,8 +855,15 @@ class Tournament(db.Model):
             self.check_winner()
 
     def handle_game_result(self, winner: Player, looser: Player):
-        winner_participant = Participant.query.get((winner.id, self.id))
-        looser_participant = Participant.query.get((looser.id, self.id))
+        participants = {
+            p.player_id: p
+            for p in Participant.query.filter(
+                Participant.tournament_id == self.id,
+                Participant.player_id.in_([winner.id, looser.id]),
+            )
+        }
+        winner_participant = participants[winner.id]
+        looser_participant = participants[looser.id]
         if winner_participant.round == looser_participant.round and not winner_participant.defeated and not looser_participant.defeated:
             looser_participant.defeated = True
             winner_participant.round += 1
@@ -778,6 +891,10 @@ class Participant(db.Model):
 
     db.UniqueConstraint(tournament_id, order)
 
+    __table_args__ = (
+        db.Index('ix_participant_tournament_round', tournament_id, round),
+    )
+
 class Ticket(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
     open = db.Column(db.Boolean(), nullable=False, default=1, server_default='1')
@@ -883,17 +1000,42 @@ class Game(db.Model):
     details = db.Column(db.Text, nullable=True)
     finish_date = db.Column(db.DateTime, nullable=True)
 
+    # maintained by GameMessageResource
+    has_message = db.Column(db.Boolean, nullable=False,
+                            default=False, server_default='0')
+
     tournament_id = db.Column(db.Integer(), db.ForeignKey(Tournament.id), index=True, nullable=True)
     tournament = db.relationship(Tournament, backref='games')
 
+    __table_args__ = (
+        # for winrate history and other finished games' date ranges
+        db.Index('ix_game_state_finish_date', state, finish_date),
+        # for games lists ordered by date
+        db.Index('ix_game_create_date', create_date),
+        db.Index('ix_game_state_create_date', state, create_date),
+    )
+
+    @property
+    def poller(self):
+        """
+        Poller class for this game's gametype.
+        Resolved once per instance, as it is used by several properties
+        which are accessed for every game being serialized.
+        """
+        cached = self.__dict__.get('_poller')
+        if not cached or cached[0] != self.gametype:
+            from .polling import Poller
+
+            cached = self.__dict__['_poller'] = (
+                self.gametype, Poller.findPoller(self.gametype))
+        return cached[1]
+
     def _make_identity_getter(kind, prop):
         def _getter(self):
             if not self.gametype:
                 return None
-            from .polling import Poller
 
-            poller = Poller.findPoller(self.gametype)
-            identity = getattr(poller, kind)
+            identity = getattr(self.poller, kind)
             if not identity:
                 return None
             return getattr(identity, prop)
@@ -917,7 +1059,7 @@ class Game(db.Model):
 
         def _getter(self):
             # formatter returns tuple (internal, human_readable)
-            return self.identity.formatter(getattr(self, attr))[seq]
+            return self.poller.identity.formatter(getattr(self, attr))[seq]
 
         return _getter
 
@@ -944,18 +1086,9 @@ class Game(db.Model):
             return self
         return self.parent.root
 
-    @property
-    def has_message(self):
-        from .routes import GameMessageResource
-
-        return bool(GameMessageResource.findfile(self))
-
     @property
     def is_ingame(self):
-        from .polling import Poller
-
-        return (self.gamemode in
-                Poller.findPoller(self.gametype).gamemodes_ingame)
+        return self.gamemode in self.poller.gamemodes_ingame
 
     @hybrid_method
     def is_game_player(self, player):
@@ -1001,6 +1134,15 @@ class ChatMessage(db.Model):
         'messages', order_by=time.asc()
     ))
 
+    # canonical (smaller id, bigger id) pair of participants,
+    # filled on insert; allows to fetch dialog with one index range scan
+    pair_a = db.Column(db.Integer, nullable=True)
+    pair_b = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_msg_pair_time', pair_a, pair_b, time),
+    )
+
     @hybrid_method
     def is_for(self, user):
         return (user.id == self.sender_id) | (user.id == self.receiver_id)
@@ -1021,15 +1163,19 @@ class ChatMessage(db.Model):
 
     @classmethod
     def for_users(cls, a, b):
-        return cls.query.filter(
-            cls.sender_id.in_([a.id, b.id]),
-            cls.receiver_id.in_([a.id, b.id]),
-        )
+        pair_a, pair_b = sorted((a.id, b.id))
+        return cls.query.filter_by(pair_a=pair_a, pair_b=pair_b)
 
     def __repr__(self):
         return '<ChatMessage id={} text={}>'.format(self.id, self.text)
 
 
+@event.listens_for(ChatMessage, 'before_insert')
+def chatmessage_set_pair(mapper, connection, msg):
+    if msg.sender_id is not None and msg.receiver_id is not None:
+        msg.pair_a, msg.pair_b = sorted((msg.sender_id, msg.receiver_id))
+
+
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # game should be the root game of inner challenges hierarchy
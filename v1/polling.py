@@ -4,12 +4,13 @@ from datetime import datetime, timedelta
 from types import SimpleNamespace
 import math
 from collections import namedtuple
-from functools import lru_cache
-from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote
 
 import requests
 from dateutil.parser import parse as date_parse
+import lxml.html
+from sqlalchemy.orm import joinedload
 
 if __name__ == '__main__':
     # debugging environment; other changes are in the bottom
@@ -61,8 +62,70 @@ Identity('starcraft_uid','StarCraft profile URL from battle.net or sc2ranks.com'
 # ea_gamertag, fifa_team, tibia_character - will be added in classes
 
 
+class Side:
+    """
+    State of one of game's players (creator or opponent)
+    used by pollers while looking for their match.
+    Each poller sets only attributes it needs.
+    """
+    __slots__ = (
+        'who', 'role', 'other',
+        'tag', 'uid', 'name', 'id', 'sid', 'pid', 'tid',
+        'info', 'dire', 'score', 'won', 'total', 'match', 'hist',
+        'deaths', 'lost', 'losedate',
+    )
+    def __init__(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+
 ### Polling ###
-class Poller:
+# Registry of poller classes, filled as they are defined:
+# list of all pollers (starting with root Poller) in definition order
+# and gametype -> poller mapping.
+_ALL_POLLERS = []
+GAMETYPE_TO_POLLER = {}
+class PollerMeta(type):
+    """
+    Registers each poller class on creation,
+    so that lookups don't need to walk subclasses tree.
+    """
+    def __init__(cls, name, bases, attrs):
+        super().__init__(name, bases, attrs)
+        _ALL_POLLERS.append(cls)
+        for gametype in cls.gametypes:
+            # first defined poller wins
+            GAMETYPE_TO_POLLER.setdefault(gametype, cls)
+
+# Executor for things to be done after game is finished.
+# Its threads are joined on exit, so pending tasks are not lost.
+_postprocessor = ThreadPoolExecutor(max_workers=4)
+def _game_finished(game_id, twitch_handle, gametype):
+    """
+    Notifies users about finished game and cancels stream watcher (if any).
+    Runs in background thread, hence takes ids rather than game object.
+    """
+    try:
+        notify_users(Game.query.get(game_id))
+    except Exception:
+        log.exception('Failed to notify users about game {}'.format(game_id))
+    finally:
+        db.session.remove()
+
+    if twitch_handle:
+        try:
+            ret = http_session.delete(
+                '{}/streams/{}/{}'.format(
+                    config.OBSERVER_URL,
+                    twitch_handle,
+                    gametype,
+                ),
+            )
+            log.info('Deleting watcher: %d' % ret.status_code)
+        except Exception:
+            log.exception('Failed to delete watcher')
+
+class Poller(metaclass=PollerMeta):
     gametypes = {} # list of supported types for this class
     gamemodes_primary = {}
     gamemodes_ingame = {}
@@ -75,6 +138,11 @@ class Poller:
     identity_id = None
     twitch_identity_id = None
     honesty = False # special for honesty-based poller
+    workers = 16 # how many games to poll simultaneously
+    batch_size = 100 # how many games to load from database at once
+    # gametype -> set of gamemodes which have accepted games,
+    # filled by poll_all; None means unknown, so poll everything.
+    active = None
     # human-readable description of how to play this game.
     # Might be dictionary if description should vary
     # for different gametypes in same poller.
@@ -101,23 +169,16 @@ class Poller:
         return Identity.get(cls.twitch_identity_id)
 
     @classmethod
-    @lru_cache()
     def findPoller(cls, gametype):
         """
         Tries to find poller class for given gametype.
         Returns None on failure.
         """
-        if gametype in cls.gametypes:
-            return cls
-        for sub in cls.__subclasses__():
-            ret = sub.findPoller(gametype)
-            if ret:
-                return ret
+        return GAMETYPE_TO_POLLER.get(gametype)
     @classmethod
     def allPollers(cls):
-        yield cls
-        for sub in cls.__subclasses__():
-            yield from sub.allPollers()
+        return (poller for poller in _ALL_POLLERS
+                if issubclass(poller, cls))
 
     @classproperty
     def gamemodes(cls):
@@ -127,16 +188,14 @@ class Poller:
         return ret
     @classproperty
     def all_gametypes(cls):
-        types = set(cls.gametypes)
-        for sub in cls.__subclasses__():
-            types.update(sub.all_gametypes)
-        return types
+        return frozenset(gametype
+                         for poller in cls.allPollers()
+                         for gametype in poller.gametypes)
     @classproperty
     def all_gamemodes(cls):
-        modes = set(cls.gamemodes)
-        for sub in cls.__subclasses__():
-            modes.update(sub.all_gamemodes)
-        return modes
+        return frozenset(gamemode
+                         for poller in cls.allPollers()
+                         for gamemode in poller.gamemodes)
 
 
     @classmethod
@@ -156,7 +215,11 @@ class Poller:
         """
         pass
     def games(self, gametype, gamemode=None):
-        ret = Game.query.filter_by(
+        # players are needed by gameDone for each finished game
+        ret = Game.query.options(
+            joinedload('creator'),
+            joinedload('opponent'),
+        ).filter_by(
             gametype = gametype,
             state = 'accepted',
         )
@@ -168,37 +231,75 @@ class Poller:
     def poll(self, now, gametype=None, gamemode=None):
         if not gametype:
             for gametype in self.gametypes:
+                if self.active is not None and gametype not in self.active:
+                    continue # no accepted games of this type
                 if not self.usemodes:
                     self.prepare()
                 self.poll(now, gametype)
             return
         if self.usemodes and not gamemode:
             for gamemode in self.gamemodes:
+                if (self.active is not None and
+                        gamemode not in self.active.get(gametype, ())):
+                    continue
                 self.prepare()
                 self.poll(now, gametype, gamemode)
             return
 
-        query = self.games(gametype, gamemode)
-        count_games = query.count()
-        count_ended = 0
-
-        log.debug('{}: polling {} games of type {} {}'.format(
+        log.debug('{}: polling games of type {} {}'.format(
             self.__class__.__name__,
-            count_games,
             gametype, gamemode
         ))
+        count_games = 0
+        count_ended = 0
 
+        # Polling a game is mostly waiting for api, so poll them in threads.
+        # Database session is not thread-safe, so pollGame gets a callback
+        # which only records finished games; gameDone is applied to them
+        # afterwards here. For the same reason workers may only read
+        # attributes already loaded by `games()` query (all game columns),
+        # as any lazy load would use this thread's session.
+        # Pollers' caches are filled from several threads, but at worst
+        # this means the same data is fetched twice.
+        # Games are loaded from database and polled in batches,
+        # so that only current batch (and finished games) stay in memory.
+        # Each batch is a separate query continuing after the last seen id,
+        # so no cursor stays open while waiting for apis.
         hourly = now.minute % 60 == 0
-        for game in query:
-            if not hourly and now - game.accept_date > timedelta(hours=12):
-                log.info('Skipping game {} because it is long-lasting'
-                         .format(game))
-                continue
+        results = []
+        def gameDone(*args, **kwargs):
+            results.append((args, kwargs))
+            return True
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            last_id = 0
+            while True:
+                games = (self.games(gametype, gamemode)
+                         .filter(Game.id > last_id)
+                         .order_by(Game.id)
+                         .limit(self.batch_size)
+                         .all())
+                if not games:
+                    break
+                last_id = games[-1].id
+                count_games += len(games)
+                batch = []
+                for game in games:
+                    if not hourly and \
+                            now - game.accept_date > timedelta(hours=12):
+                        log.info('Skipping game {} because it is long-lasting'
+                                 .format(game))
+                        continue
+                    batch.append(game)
+                if batch:
+                    self.pollBatch(executor, batch, gameDone)
+
+        for args, kwargs in results:
             try:
-                if self.pollGame(game):
-                    count_ended += 1
+                type(self).gameDone(*args, **kwargs)
+                count_ended += 1
             except Exception:
-                log.exception('Failed to poll game {}'.format(game))
+                log.exception('Failed to finish game {}'.format(args[0]))
+                db.session.rollback()
 
         db.session.commit()
 
@@ -212,7 +313,7 @@ class Poller:
         Mark the game as done, setting all needed fields.
         Winner is a string.
         Timestamp is in seconds, or it can be datetime object, or None for now.
-        Returns True for convenience (`return self.gameDone(...)`).
+        Returns True for convenience (`return gameDone(...)`).
         """
         log.debug('Marking game {} as done'.format(game))
         if winner == 'aborted':
@@ -228,9 +329,14 @@ class Poller:
             game.finish_date = timestamp
         else:
             game.finish_date = datetime.utcfromtimestamp(timestamp)
-        db.session.commit() # to avoid observer overwriting it before us..
-
-        # move funds (only if somebody won)
+        # Game state and funds are committed together below;
+        # flushing locks the game row so observer cannot overwrite it
+        # before us.
+        db.session.flush()
+
+        # move funds (only if somebody won).
+        # Balances are changed with sql expressions rather than in python
+        # because other pollers may be handling the same players concurrently.
         if winner in ['creator', 'opponent']:
             if winner == 'creator':
                 winner = game.creator
@@ -238,8 +344,9 @@ class Poller:
             elif winner == 'opponent':
                 winner = game.opponent
                 looser = game.creator
-            winner.balance += game.bet
-            looser.balance -= game.bet
+            winner.balance = Player.balance + game.bet
+            looser.balance = Player.balance - game.bet
+            db.session.flush() # now balance attributes will load new values
             db.session.add(Transaction(
                 player = winner,
                 type = 'won',
@@ -256,26 +363,17 @@ class Poller:
             ))
         # and unlock bets (always)
         # withdrawing them finally from accounts
-        game.creator.locked -= game.bet
-        game.opponent.locked -= game.bet
+        game.creator.locked = Player.locked - game.bet
+        game.opponent.locked = Player.locked - game.bet
 
         db.session.commit()
 
-        notify_users(game)
-
-        # cancel stream watcher (if any)
-        if game.twitch_handle:
-            try:
-                ret = requests.delete(
-                    '{}/streams/{}/{}'.format(
-                        config.OBSERVER_URL,
-                        game.twitch_handle,
-                        game.gametype,
-                    ),
-                )
-                log.info('Deleting watcher: %d' % ret.status_code)
-            except Exception:
-                log.exception('Failed to delete watcher')
+        # Notifications and watcher removal are best-effort
+        # and may be slow, so don't make poller wait for them.
+        _postprocessor.submit(
+            with_app_context(_game_finished),
+            game.id, game.twitch_handle, game.gametype,
+        )
 
         return True # for convenience
 
@@ -290,15 +388,35 @@ class Poller:
             text = text,
         )
 
+    def pollBatch(self, executor, games, gameDone):
+        """
+        Polls given games simultaneously using given executor,
+        logging failures. Returns when all of them are done.
+        `gameDone` is passed to `pollGame`.
+        """
+        futures = {
+            executor.submit(with_app_context(self.pollGame), game, gameDone):
+                game
+            for game in games
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                log.exception('Failed to poll game {}'.format(
+                    futures[future]))
+
     def prepare(self):
         """
         Prepare self for new polling, clear all caches.
         """
         pass
 
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         """
         Shall be overriden by subclasses.
+        Finished games should be reported with `gameDone` callback
+        which has the same signature as `Poller.gameDone`.
         Returns True if given game was successfully processed.
         """
         raise NotImplementedError
@@ -407,7 +525,7 @@ class FifaPoller(Poller, LimitedApi):
             '{}/match-history/{}/{}'.format(
                 gametype, gamemode, quote(nick))
         try:
-            return cls.request_json('GET', url)['data']
+            return cls.request_conditional(url, lambda ret: ret.json()['data'])
         except Exception as e:
             log.error('Failed to fetch match info '
                       'for player {}, gt {} gm {}'.format(
@@ -415,12 +533,13 @@ class FifaPoller(Poller, LimitedApi):
                       exc_info=False) # XXX disabled
             return []
 
-    def pollGame(self, game, who=None, matches=None):
+    def pollGame(self, game, gameDone, who=None, matches=None):
         if not who:
             for who in ['creator', 'opponent']:
                 tag = getattr(game, 'gamertag_'+who)
                 if tag in self.gamertags:
-                    return self.pollGame(game, who, self.gamertags[tag])
+                    return self.pollGame(game, gameDone, who,
+                                         self.gamertags[tag])
 
             who = 'creator'
             matches = self.fetch(game.gametype, game.gamemode,
@@ -428,8 +547,8 @@ class FifaPoller(Poller, LimitedApi):
             # and cache it
             self.gamertags[game.gamertag_creator] = matches
 
-        crea = SimpleNamespace(who='creator')
-        oppo = SimpleNamespace(who='opponent')
+        crea = Side(who='creator')
+        oppo = Side(who='opponent')
         for user in [crea, oppo]:
             user.tag = getattr(game, 'gamertag_'+user.who)
         # `me` is the `who` player object
@@ -437,6 +556,8 @@ class FifaPoller(Poller, LimitedApi):
         me.role = 'self'
         other.role = 'opponent'
 
+        game_ts = math.floor(game.accept_date.timestamp())
+        other_tag = other.tag.lower()
         # now that we have who and matches, try to find corresponding match
         for match in reversed(matches): # from oldest to newest
             log.debug('match: {} cr {}, op {}'.format(
@@ -446,15 +567,13 @@ class FifaPoller(Poller, LimitedApi):
                 ]
             ))
             # skip this match if it ended before game's start
-            if math.floor(game.accept_date.timestamp()) \
-                    > match['timestamp'] + 4*3600: # delta of 4 hours
+            if game_ts > match['timestamp'] + 4*3600: # delta of 4 hours
                 log.debug('Skipping match because of time')
                 continue
 
-            if other.tag.lower() not in map(
-                lambda t: t.lower(),
-                match['opponent']['user_info']
-            ):
+            if other_tag not in {
+                t.lower() for t in match['opponent']['user_info']
+            }:
                 log.debug('Skipping match because of participants')
                 continue
 
@@ -468,7 +587,7 @@ class FifaPoller(Poller, LimitedApi):
                 winner = 'opponent'
             else:
                 winner = 'draw'
-            self.gameDone(game, winner, match['timestamp'],
+            gameDone(game, winner, match['timestamp'],
                           'Score: {} - {}'.format(crea.score, oppo.score))
             return True
 
@@ -492,35 +611,35 @@ class RiotPoller(Poller):
     def prepare(self):
         self.matches = {}
 
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         def parseSummoner(val):
             region, val = val.split('/', 1)
             name, id = val.rsplit('/', 1)
             return region, name, int(id)
-        crea = SimpleNamespace()
-        oppo = SimpleNamespace()
+        crea = Side()
+        oppo = Side()
         region, crea.name, crea.sid = parseSummoner(game.gamertag_creator)
         region2, oppo.name, oppo.sid = parseSummoner(game.gamertag_opponent)
+        users = (crea, oppo)
         if region2 != region:
             log.error('Invalid game, different regions! id {}'.format(game.id))
             # TODO: mark game as invalid?..
             return False
 
-        def checkMatch(match_ref):
+        def fetchMatch(mid):
             # fetch match details
-            mid = match_ref['matchId']
-            if mid in self.matches:
-                ret = self.matches[mid]
-            else:
-                ret = Riot.call(
+            if mid not in self.matches:
+                self.matches[mid] = Riot.call(
                     region,
                     'v2.2',
                     'match/'+mid,
                 )
-                self.matches[mid] = ret
+            return self.matches[mid]
+
+        def checkMatch(ret):
             crea.pid = oppo.pid = None # participant id
             for participant in ret['participantIdentities']:
-                for user in [crea, oppo]:
+                for user in users:
                     if participant['player']['summonerId'] == user.sid:
                         user.pid = participant['participantId']
             if not oppo.pid:
@@ -530,7 +649,7 @@ class RiotPoller(Poller):
             crea.tid = oppo.tid = None
             crea.won = oppo.won = None
             for participant in ret['participants']:
-                for user in [crea, oppo]:
+                for user in users:
                     if participant['participantId'] == user.pid:
                         user.tid = participant['teamId']
                         user.won = participant['stats']['winner']
@@ -540,7 +659,7 @@ class RiotPoller(Poller):
                 # skip this match
                 return False
 
-            self.gameDone(
+            gameDone(
                 game,
                 'creator' if crea.won else
                 'opponent' if oppo.won else
@@ -563,8 +682,11 @@ class RiotPoller(Poller):
                 ),
             )
 
+            # Matches are fetched one by one, as Riot's rate limit
+            # serializes requests anyway; stop at the first matching one
+            # so that no api calls are wasted.
             for match in ret['matches']:
-                if checkMatch(match):
+                if checkMatch(fetchMatch(match['matchId'])):
                     return True
 
             shift += 20
@@ -588,13 +710,15 @@ class Dota2Poller(Poller):
     def prepare(self):
         self.matchlists = {}
 
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         from_oppo = False
         matchlist = self.matchlists.get(game.gamertag_creator_val)
         if not matchlist:
             matchlist = self.matchlists.get(game.gamertag_opponent_val)
             from_oppo = True
-        if not match:
+        game_ts = game.accept_date.timestamp()
+        if not matchlist:
+            from_oppo = False
             # TODO: handle pagination
             # Match list is sorted by start time descending,
             # and 100 matches are returned by default,
@@ -602,7 +726,7 @@ class Dota2Poller(Poller):
             matchlist = Steam.dota2(
                 method = 'GetMatchHistory',
                 account_id = game.gamertag_creator_val, # it is in str, but doesn't matter here
-                date_min = round(game.accept_date.timestamp()),
+                date_min = round(game_ts),
             ).get('matches')
             # TODO: merge all matches in cache, index by match id,
             # and search players in all matches available -
@@ -610,17 +734,19 @@ class Dota2Poller(Poller):
             if not matchlist:
                 raise ValueError('Couldn\'t fetch match list for account id {}'
                                  .format(game.gamertag_creator_val))
-            self.matchlists[game.gamertag_creator_val] = match['matches']
+            self.matchlists[game.gamertag_creator_val] = matchlist
+        # the other player, to be found in matches from the list
+        target = int(game.gamertag_creator_val
+                     if from_oppo else
+                     game.gamertag_opponent_val)
         for match in matchlist:
-            if match['start_time'] < game.accept_date.timestamp:
+            if match['start_time'] < game_ts:
                 # this match is too old, subsequent are older -> not found
                 break
-            player_ids = (Steam.id_to_64(p['account_id'])
+            player_ids = {Steam.id_to_64(p['account_id'])
                           for p in match['players']
-                          if 'account_id' in p)
-            if int(game.gamertag_creator_val
-                   if from_oppo else
-                   game.gamertag_opponent_val) in player_ids:
+                          if 'account_id' in p}
+            if target in player_ids:
                 # found the right match
                 # now load its details to determine winner and duration
 
@@ -631,8 +757,8 @@ class Dota2Poller(Poller):
                 # TODO: update it in cache?
 
                 # determine winner
-                crea = SimpleNamespace()
-                oppo = SimpleNamespace()
+                crea = Side()
+                oppo = Side()
                 crea.id, oppo.id = map(int,
                                        [game.gamertag_creator_val,
                                         game.gamertag_opponent_val])
@@ -660,7 +786,7 @@ class Dota2Poller(Poller):
                 else:
                     winner = 'creator' if crea.won else 'opponent'
 
-                return self.gameDone(
+                return gameDone(
                     game,
                     winner,
                     match['start_time'] + match['duration']
@@ -696,10 +822,11 @@ class CSGOPoller(Poller):
         def __eq__(self, other):
             # all of the following properties should match
             # to consider two matches equal
-            return all(map(
-                lambda attr: getattr(self, attr) == getattr(other, attr),
-                [ 'rounds', 'max_players', ]
-            ))
+            return (self.rounds == other.rounds and
+                    self.max_players == other.max_players)
+        def __ne__(self, other):
+            # tuple defines its own __ne__ comparing all fields
+            return not self == other
     @classmethod
     def fetch_match(cls, userid):
         log.debug('Fetching matches for user id %s'%userid)
@@ -725,9 +852,9 @@ class CSGOPoller(Poller):
         ))
     def prepare(self):
         self.matches = {}
-    def pollGame(self, game):
-        crea = SimpleNamespace(tag=game.gamertag_creator_val)
-        oppo = SimpleNamespace(tag=game.gamertag_opponent_val)
+    def pollGame(self, game, gameDone):
+        crea = Side(tag=game.gamertag_creator_val)
+        oppo = Side(tag=game.gamertag_opponent_val)
         crea.total, oppo.total = map(int, game.meta.split(':'))
         for user in crea, oppo:
             if user.tag not in self.matches:
@@ -746,8 +873,8 @@ class CSGOPoller(Poller):
         if crea.won == oppo.won:
             winner = 'draw'
         else:
-            user = 'creator' if crea.won else 'opponent'
-        return self.gameDone(
+            winner = 'creator' if crea.won else 'opponent'
+        return gameDone(
             game,
             winner,
             None, # now - as we don't know exact match ending time
@@ -767,14 +894,14 @@ class StarCraftPoller(Poller):
 
     def prepare(self):
         self.lists = {}
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         """
         For SC2, we cannot determine user's opponent in match.
         So we just fetch histories for both players
         and look for identical match.
         """
-        crea = SimpleNamespace(uid=game.gamertag_creator)
-        oppo = SimpleNamespace(uid=game.gamertag_opponent)
+        crea = Side(uid=game.gamertag_creator)
+        oppo = Side(uid=game.gamertag_opponent)
         if crea.uid.split('/')[0] != oppo.uid.split('/')[0]:
             # should be filtered in endpoint...
             raise ValueError('Region mismatch')
@@ -787,18 +914,23 @@ class StarCraftPoller(Poller):
                 self.lists[user.uid] = ret['matches']
             user.hist = [m for m in self.lists[user.uid]
                          if m['date'] >= game_ts]
+        # index opponent's matches by fields identifying the match;
+        # keep the first one for each key, like sequential scan did
+        oppo_idx = {}
+        for mo in oppo.hist:
+            oppo_idx.setdefault(
+                (mo['map'], mo['type'], mo['speed'], mo['date']), mo)
         for mc in crea.hist:
-            for mo in oppo.hist:
-                if all(map(lambda field: mc[field] == mo[field],
-                           ['map', 'type', 'speed', 'date'])):
-                    # found the match
-                    if mc['decision'] == mo['decision']:
-                        winner = 'draw'
-                    else:
-                        winner = ('creator'
-                                  if mc['decision'] == 'WIN' else
-                                  'opponent')
-                    return self.gameDone(game, winner, mc['date'])
+            mo = oppo_idx.get((mc['map'], mc['type'], mc['speed'], mc['date']))
+            if mo:
+                # found the match
+                if mc['decision'] == mo['decision']:
+                    winner = 'draw'
+                else:
+                    winner = ('creator'
+                              if mc['decision'] == 'WIN' else
+                              'opponent')
+                return gameDone(game, winner, mc['date'])
 
 class TibiaPoller(Poller, LimitedApi):
     gametypes = {
@@ -820,85 +952,53 @@ class TibiaPoller(Poller, LimitedApi):
         Important: both characters should reside in the same world.
     """
 
-    class Parser(HTMLParser):
-        def __call__(self, page):
-            self.tags = []
-            self.name = None
-            self.char_404 = False
-            self.deaths_found = False
-            self.deaths = []
-            try:
-                self.feed(page)
-                self.close()
-            except StopIteration:
-                pass
-            if self.char_404:
-                return None, None
-            return self.name, self.deaths
-        @property
-        def tag(self):
-            return self.tags[-1] if self.tags else None
-        def handle_starttag(self, tag, attrs):
-            self.tags.append(tag)
-            self.attrs = dict(attrs)
-        def handle_data(self, data):
-            if self.name is None and self.tag == 'td' and data == 'Name:':
-                self.name = ''
-                return
-            if self.name == '' and self.tag == 'td':
-                self.name = data
-                return
-            if self.tag == 'b':
-                if data == 'Could not find character':
-                    self.char_404 = True
-                    raise StopIteration
-                if data == 'Character Deaths':
-                    self.deaths_found = True
-                    self.date = None
-                    self.msg = None
-                    self.players = None
-                return
-            if not self.deaths_found:
-                return
-            # here deaths_found == True
-            if(self.tag == 'td'
-               and self.attrs.get('width') == '25%'
-               and self.attrs.get('valign') == 'top'):
-                # date
-                if self.msg:
-                    self.deaths.append(
-                        (self.date, self.msg, self.players)
-                    )
-                self.date = date_parse(data.replace('\xA0', ' '))
-                self.msg = ''
-                self.players = []
-            elif self.date:
-                self.msg += data
-                if self.tag == 'a':
-                    self.players.append(data)
-        def handle_endtag(self, tag):
-            self.tags.pop()
-            if self.deaths_found and tag == 'table':
-                self.deaths.append(
-                    (self.date, self.msg, self.players)
-                )
-                raise StopIteration
+    @classmethod
+    def parse(cls, page):
+        """
+        Parses character page.
+        Returns tuple of character name and list of deaths,
+        each being a tuple (date, message, killers).
+        If there is no such character, returns (None, None).
+        """
+        tree = lxml.html.fromstring(page)
+        if tree.xpath('//b[text()="Could not find character"]'):
+            return None, None
+
+        name = None
+        for td in tree.xpath('//td[text()="Name:"]/following-sibling::td[1]'):
+            name = str(td.text_content())
+            break
+
+        deaths = []
+        for table in tree.xpath(
+            '//b[text()="Character Deaths"]/ancestor::table[1]'
+        ):
+            for datetd in table.xpath(
+                './/td[@width="25%" and @valign="top"]'
+            ):
+                rest = datetd.xpath('following-sibling::td')
+                deaths.append((
+                    date_parse(datetd.text_content().replace('\xA0', ' ')),
+                    ''.join(str(td.text_content()) for td in rest),
+                    [str(a.text_content())
+                     for td in rest for a in td.iter('a')],
+                ))
+            break
+        return name, deaths
     @classmethod
     def fetch(cls, playername):
         """
         If player found, returns tuple of normalized name and list of deaths.
         If player not found, returns (None, None).
         """
-        page = cls.request(
-            'GET',
+        ret = cls.request_conditional(
             'http://www.tibia.com/community/',
+            lambda page: cls.parse(page.text),
             params=dict(
                 subtopic = 'characters',
                 name = playername,
             ),
-        ).text
-        parser = cls.Parser(convert_charrefs=True)
-        ret = parser(page)
+        )
         log.debug('TibiaPoller: fetching character {}: {}'.format(
             playername, ret))
         return ret
@@ -919,9 +1019,9 @@ class TibiaPoller(Poller, LimitedApi):
             _, deaths = self.fetch(name)
             self.players[name] = deaths
         return self.players[name]
-    def pollGame(self, game):
-        crea = SimpleNamespace(uid=game.gamertag_creator, role='creator')
-        oppo = SimpleNamespace(uid=game.gamertag_opponent, role='opponent')
+    def pollGame(self, game, gameDone):
+        crea = Side(uid=game.gamertag_creator, role='creator')
+        oppo = Side(uid=game.gamertag_opponent, role='opponent')
         crea.other, oppo.other = oppo, crea
         for user in crea, oppo:
             user.deaths = self.getDeaths(user.uid)
@@ -948,7 +1048,7 @@ class TibiaPoller(Poller, LimitedApi):
                         date = user.other.losedate
                         winner = user.role
                     # else - killed each other but this was killed first
-                return self.gameDone(game, user.other.role, user.losedate)
+                return gameDone(game, user.other.role, user.losedate)
         return False
 
 
@@ -990,7 +1090,7 @@ class DummyPoller(Poller):
         'call-of-duty-black-ops-3': 'Black Ops III',
     }
 
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         pass
 
 class TestPoller(Poller):
@@ -1002,7 +1102,7 @@ class TestPoller(Poller):
     twitch_gametypes = {
         'test': 'None', # to allow missing streams
     }
-    def pollGame(self, game):
+    def pollGame(self, game, gameDone):
         pass
 
 # validation
@@ -1020,15 +1120,43 @@ def poll_all():
         datetime.utcnow().timestamp() // (5*60) * (5*60)
     )
 
-    # TODO: run them all simultaneously in background, to use 2sec api delays
+    # Find out which gametypes and gamemodes have games to poll at all,
+    # so that pollers don't query (and prepare for) empty ones.
+    active = {}
+    for gametype, gamemode in db.session.query(
+        Game.gametype, Game.gamemode,
+    ).filter_by(state='accepted').distinct():
+        active.setdefault(gametype, set()).add(gamemode)
+
+    pollers = []
     for poller in Poller.allPollers():
         if not poller.identity: # root or dummy
             continue
+        if not any(gametype in active for gametype in poller.gametypes):
+            log.debug('Skipping poller {} as it has no games'.format(poller))
+            continue
         if poller.minutes and now.minute % poller.minutes != 0:
             log.info('Skipping poller {} because of timeframes'.format(poller))
             continue
-        pin = poller()
-        pin.poll(now)
+        pollers.append(poller)
+
+    # Pollers are independent and spend most of their time
+    # waiting for apis (and their delays), so run them all simultaneously.
+    # Each thread gets its own app context and hence its own db session.
+    @with_app_context
+    def run(poller):
+        try:
+            pin = poller()
+            pin.active = active
+            pin.poll(now)
+        except Exception:
+            log.exception('Poller {} failed'.format(poller.__name__))
+        finally:
+            db.session.remove()
+
+    if pollers:
+        with ThreadPoolExecutor(max_workers=len(pollers)) as executor:
+            list(executor.map(run, pollers))
 
     log.info('Polling done')
 
@@ -1052,8 +1180,19 @@ if __name__ == '__main__':
                 dup = self.__class__(**self.__dict__)
                 dup.__dict__.update(kwargs)
                 return dup
+            def filter(self, *conds):
+                # conditions are (key, value) pairs produced by _Column
+                return self.filter_by(**dict(conds))
+            def options(self, *args):
+                return self
+            def order_by(self, *args):
+                return self
+            def limit(self, count):
+                return self
             def count(self):
                 return 1
+            def all(self):
+                return list(self)
             def __iter__(self):
                 key = tuple((k,v) for k,v in self.__dict__.items()
                         if not k.startswith('_'))
@@ -1062,6 +1201,8 @@ if __name__ == '__main__':
                 if not self.__class__._game:
                     self.__class__._game = Game()
                 game = self.__class__._game
+                if game.id <= getattr(self, '_after', 0):
+                    return
                 for attr in ('gametype', 'gamemode', 'start',
                              'gamertag_creator', 'gamertag_opponent'):
                     setattr(game, attr, getattr(
@@ -1075,6 +1216,11 @@ if __name__ == '__main__':
                 return next(iter(self))
             def clear(self):
                 self.__class__._game = None
+        class _Column:
+            # mimics column comparison used in Query.filter
+            def __gt__(self, value):
+                return ('_after', value)
+        id = _Column()
         query = Query()
         root = 'Gaming session'
         _isDone = False
@@ -1087,6 +1233,7 @@ if __name__ == '__main__':
             self.start = datetime.now()
 
             self.meta = None
+            self.id = 1
             self._silent = False
         @property
         def accept_date(self):
@@ -3,7 +3,8 @@ from flask import copy_current_request_context
 from flask.ext import restful
 from flask.ext.restful import fields, marshal
 from flask.ext.socketio import send as sio_send, disconnect as sio_disconnect
-from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.expression import func, tuple_
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.exc import IntegrityError
 
 from werkzeug.exceptions import HTTPException
@@ -11,11 +12,16 @@ from werkzeug.exceptions import MethodNotAllowed, Forbidden, NotFound
 from werkzeug.exceptions import NotImplemented # noqa
 
 import os
+import re
+import base64
+import shutil
+import tempfile
 from io import BytesIO
 from datetime import datetime, timedelta
 import math
 import json
 import operator
+from functools import lru_cache
 import requests
 from PIL import Image
 import eventlet
@@ -32,6 +38,12 @@ from .main import app, db, api, socketio, redis
 
 
 # Players
+# allowed leaderboard orders
+LEADERBOARD_ORDERS = order_choices(
+    'id', 'lastbet', 'popularity', 'winrate', 'gamecount',
+)
+
+
 @api.resource(
     '/players',
     '/players/',
@@ -68,7 +80,9 @@ class PlayerResource(restful.Resource):
             partial.add_argument(
                 name,
                 required=False,
-                type=type,
+                # resubmitted values (e.g. whole profile form)
+                # need not be checked again
+                type=unchanged_field(name, type),
             )
         login.add_argument('push_token',
                            type=string_field(Device.push_token,
@@ -79,7 +93,9 @@ class PlayerResource(restful.Resource):
         return parser
 
     @classmethod
+    @lru_cache()
     def fields(cls, public=True, stat=False, leaders=False):
+        # Result is cached and shared between callers, don't modify it.
         ret = dict(
             id=fields.Integer,
             nickname=fields.String,
@@ -115,6 +131,21 @@ class PlayerResource(restful.Resource):
         ))
         return ret
 
+    @classmethod
+    @lru_cache()
+    def leaderboard_format(cls, leaders):
+        """
+        Returns prebuilt formatter for leaderboard players.
+        Field classes are instantiated here once
+        rather than for each player on every request.
+        Gamecount and winrate are excluded as they are filled separately.
+        """
+        playerfields = field_instances(cls.fields(public=True, stat=True,
+                                                  leaders=leaders))
+        del playerfields['gamecount']
+        del playerfields['winrate']
+        return fields.List(fields.Nested(playerfields))
+
     @classmethod
     def login_do(cls, player, args=None, created=False):
         if not args:
@@ -160,15 +191,7 @@ class PlayerResource(restful.Resource):
                                 )
             parser.add_argument(
                 'order',
-                choices=sum(
-                    [[s, '-' + s]
-                     for s in
-                     ('id',
-                      'lastbet',
-                      'popularity',
-                      'winrate',
-                      'gamecount',
-                      )], []),
+                choices=LEADERBOARD_ORDERS,
                 required=False,
             )
             parser.add_argument('gametype',
@@ -179,6 +202,7 @@ class PlayerResource(restful.Resource):
                                 choices=[
                                     'today', 'yesterday', 'week', 'month',
                                 ])
+            parser.add_argument('after')  # cursor from previous page
             # parser.add_argument('names_only', type=boolean_field)
             args = parser.parse_args()
 
@@ -213,10 +237,19 @@ class PlayerResource(restful.Resource):
                         filters.append(Game.accept_date >= now - since)
                         if till:
                             filters.append(Game.accept_date < now - till)
-                    orders.append(getattr(Player, ordername + '_impl')(*filters))
+                    order = getattr(Player, ordername + '_impl')(*filters)
                     g.winrate_filt = filters
                 else:
-                    orders.append(getattr(Player, ordername))
+                    order = getattr(Player, ordername)
+                if ordername in ('winrate', 'lastbet'):
+                    # These are NULL for players without games;
+                    # replace with values which sort the same way
+                    # so that they can be compared with cursor values.
+                    order = func.coalesce(
+                        order,
+                        -1 if ordername == 'winrate' else datetime(1970, 1, 1),
+                    )
+                orders.append(order)
                 # special handling for order by winrate:
                 if args.order.endswith('winrate'):
                     # sort also by game count
@@ -224,23 +257,57 @@ class PlayerResource(restful.Resource):
                     # ...and always add player.id to stabilize order
             if not args.order or not args.order.endswith('id'):
                 orders.append(Player.id)
-            if args.order:
-                orders = map(
-                    operator.methodcaller(
-                        'desc' if args.order.startswith('-') else 'asc'
-                    ), orders
+            descending = bool(args.order) and args.order.startswith('-')
+
+            # Keyset pagination: continue right after the last player
+            # of previous page instead of skipping rows with OFFSET.
+            if args.after:
+                try:
+                    after = json.loads(base64.urlsafe_b64decode(
+                        args.after.encode()).decode())
+                except ValueError:
+                    after = None
+                if (not isinstance(after, list) or
+                        len(after) != len(orders) or
+                        not all(item is None or
+                                isinstance(item, (str, int, float))
+                                for item in after)):
+                    abort('[after]: Bad cursor', problem='after')
+                query = query.filter(
+                    (tuple_(*orders) < tuple_(*after))
+                    if descending else
+                    (tuple_(*orders) > tuple_(*after))
                 )
-            query = query.order_by(*orders)
 
-            query = query.limit(20)
+            query = query.add_columns(*orders).order_by(*map(
+                operator.methodcaller('desc' if descending else 'asc'),
+                orders
+            ))
+
+            rows = query.limit(21).all()  # one more to know if there is next
+            if len(rows) > 20:
+                rows = rows[:20]
+                next_cursor = base64.urlsafe_b64encode(json.dumps(
+                    list(rows[-1][1:]), default=str,
+                ).encode()).decode()
+            else:
+                next_cursor = None
+            players = [row[0] for row in rows]
+
+            # gamecount and winrate are fetched for the whole page
+            # with one query instead of subqueries per player
+            stats = Player.stats_for(
+                [p.id for p in players],
+                *(g.winrate_filt if 'winrate_filt' in g else []))
+            ret = self.leaderboard_format(
+                'winrate' in (args.order or '')).format(players)
+            for player, item in zip(players, ret):
+                item['gamecount'], item['winrate'] = stats.get(player.id,
+                                                               (0, None))
 
             return jsonify(
-                players=fields.List(
-                    fields.Nested(
-                        self.fields(public=True, stat=True,
-                                    leaders='winrate' in (args.order or ''))
-                    )
-                ).format(query),
+                players=ret,
+                next_cursor=next_cursor,
             )
 
         parser = RequestParser()
@@ -310,7 +377,7 @@ class PlayerResource(restful.Resource):
         if not id:
             raise MethodNotAllowed
 
-        if Player.find(id) != user:
+        if not user.matches(id):
             abort('You cannot edit another player\'s info', 403)
 
         args = self.parser.partial.parse_args()
@@ -331,7 +398,7 @@ class PlayerResource(restful.Resource):
         hadmail = bool(user.email)
 
         for key, val in args.items():
-            if val and hasattr(user, key):
+            if val and hasattr(user, key) and getattr(user, key) != val:
                 setattr(user, key, val)
                 if not hadmail and key == 'email':
                     self.greet(user)
@@ -375,18 +442,24 @@ class PlayerResource(restful.Resource):
         email = None
         # get identity, name, email and userpic
         if args.svc == 'facebook':
-            try:
-                args.token = federatedRenewFacebook(args.token)
-            except ValueError as e:
-                abort('[token]: {}'.format(e), problem='token')
+            # Renewing token and fetching profile are independent
+            # (current token is still valid), so do them simultaneously.
+            renewal = eventlet.spawn(
+                copy_current_request_context(federatedRenewFacebook),
+                args.token,
+            )
             # get identity and name
-            ret = requests.get(
+            ret = http_session.get(
                 'https://graph.facebook.com/v2.3/me',
                 params=dict(
                     access_token=args.token,
                     fields='id,email,name,picture',
                 ),
             )
+            try:
+                args.token = renewal.wait()
+            except ValueError as e:
+                abort('[token]: {}'.format(e), problem='token')
             jret = ret.json()
             if 'error' in jret:
                 err = jret['error']
@@ -436,9 +509,19 @@ class PlayerResource(restful.Resource):
                 abort('Failed to fetch account information from WilliamHill')
 
         if name:
+            # fetch all possibly conflicting nicknames at once
+            # (comparing lowercased as nickname column is case-insensitive)
+            taken = {
+                nick.lower() for nick, in
+                db.session.query(Player.nickname).filter(Player.nickname.like(
+                    name.replace('!', '!!')
+                        .replace('%', '!%').replace('_', '!_') + '%',
+                    escape='!',
+                ))
+            }
             n = 1
             oname = name
-            while Player.query.filter_by(nickname=name).count():
+            while name.lower() in taken:
                 name = '{} {}'.format(oname, n)
                 n += 1
 
@@ -498,7 +581,7 @@ class PlayerResource(restful.Resource):
     @app.route('/players/<id>/pushtoken', methods=['POST'])
     @require_auth
     def pushtoken(user, id):
-        if Player.find(id) != user:
+        if not user.matches(id):
             raise Forbidden
 
         if not g.device_id:
@@ -540,7 +623,7 @@ class PlayerResource(restful.Resource):
     @app.route('/players/<id>/logout', methods=['POST'])
     @require_auth
     def logout(user, id):
-        if Player.find(id) != user:
+        if not user.matches(id):
             raise Forbidden
 
         if not g.device_id:
@@ -578,7 +661,7 @@ class PlayerResource(restful.Resource):
     @app.route('/players/<id>/recent_opponents')
     @require_auth
     def recent_opponents(user, id):
-        if Player.find(id) != user:
+        if not user.matches(id):
             raise Forbidden
 
         return jsonify(opponents=fields.List(fields.Nested(
@@ -588,7 +671,7 @@ class PlayerResource(restful.Resource):
     @app.route('/players/<id>/winratehist')
     @require_auth
     def winratehist(user, id):
-        if Player.find(id) != user:
+        if not user.matches(id):
             raise Forbidden
         parser = RequestParser()
         parser.add_argument('range', type=int, required=True)
@@ -604,8 +687,8 @@ class PlayerResource(restful.Resource):
                 dict(
                     date=date,
                     games=total,
-                    wins=float(wins),
-                    rate=float(rate),
+                    wins=wins,
+                    rate=rate,
                 ) for date, total, wins, rate in user.winratehist(**params)
             ],
         )
@@ -650,6 +733,15 @@ class UploadableResource(restful.Resource):
     ROOT = os.path.dirname(__file__) + '/../uploads'
     SUBDIR = None
     ALLOWED = None
+    # name of entity's boolean column which tracks file presence
+    FLAG = None
+    # how long clients may use cached file without revalidating, in seconds
+    CACHE_TIMEOUT = 3600
+    PUBLIC = False  # may shared caches store it?
+    # If set, uploads are decoded as images,
+    # shrunk to fit this size and saved as PNG.
+    MAX_IMAGE_SIZE = None
+    MAX_IMAGE_PIXELS = 25000000  # refuse to decode anything bigger
 
     @classmethod
     def url_for(cls, entity, ext):
@@ -674,21 +766,36 @@ class UploadableResource(restful.Resource):
                 return f
         return None
 
+    @classmethod
+    def setflag(cls, entity, value):
+        """
+        Updates entity's flag; returns True if it was changed.
+        Doesn't commit, so that flag is saved along with caller's changes.
+        """
+        if cls.FLAG and getattr(entity, cls.FLAG) != value:
+            setattr(entity, cls.FLAG, value)
+            return True
+        return False
+
     @classmethod
     def onupload(cls, entity, ext):
-        pass
+        cls.setflag(entity, True)
 
     @classmethod
     def ondelete(cls, entity):
-        pass
+        cls.setflag(entity, False)
 
+    # self-healing for flags which got out of sync with filesystem;
+    # GET changes nothing else, so it is safe to commit here
     @classmethod
     def found(cls, entity, ext):
-        pass
+        if cls.setflag(entity, True):
+            db.session.commit()
 
     @classmethod
     def notfound(cls, entity):
-        pass
+        if cls.setflag(entity, False):
+            db.session.commit()
 
     @classmethod
     def delfile(cls, entity):
@@ -711,30 +818,59 @@ class UploadableResource(restful.Resource):
 
         # FIXME: limit size
 
+        if cls.MAX_IMAGE_SIZE:
+            # decode before deleting old file, so that it is kept on failure
+            img = cls.load_image(f.stream)
+
         cls.delfile(entity)
 
-        f.save(cls.file_for(entity, ext))
+        if cls.MAX_IMAGE_SIZE:
+            img.save(cls.file_for(entity, ext), format='PNG', optimize=True)
+        else:
+            f.save(cls.file_for(entity, ext))
 
         cls.onupload(entity, ext)
 
         datadog('{} uploaded'.format(cls.PARAM), 'original filename: {}'.format(
             f.filename))
 
+    @classmethod
+    def load_image(cls, stream):
+        """
+        Decodes uploaded image and shrinks it to fit MAX_IMAGE_SIZE.
+        """
+        try:
+            img = Image.open(stream)
+        except IOError:
+            abort('[{}]: not an image'.format(cls.PARAM))
+        # check dimensions (read from header) before decoding pixels
+        if img.size[0] * img.size[1] > cls.MAX_IMAGE_PIXELS:
+            abort('[{}]: image is too large'.format(cls.PARAM))
+        try:
+            img.thumbnail((cls.MAX_IMAGE_SIZE, cls.MAX_IMAGE_SIZE),
+                          Image.LANCZOS)
+            # PNG cannot store e.g. CMYK (from JPEG), so convert these
+            if img.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        except IOError:
+            abort('[{}]: broken image'.format(cls.PARAM))
+        return img
+
     @classmethod
     def fromurl(cls, url, entity):
         if len(cls.ALLOWED) > 1:
             raise ValueError('This is only applicable for single-ext resources')
 
         cls.delfile(entity)
-        ret = requests.get(url, stream=True)
+        ret = http_session.get(url, stream=True, timeout=30)
+        ret.raw.decode_content = True  # handle gzip etc like iter_content
         with open(cls.file_for(entity, cls.ALLOWED[0]), 'wb') as f:
-            for chunk in ret.iter_content(1024):
-                f.write(chunk)
+            shutil.copyfileobj(ret.raw, f, 64 * 1024)
 
         cls.onupload(entity, cls.ALLOWED[0])
 
-        datadog('{} uploaded from url'.format(cls.PARAM), 'original filename: {}, url: {}'.format(
-            f.filename, url))
+        datadog('{} uploaded from url'.format(cls.PARAM), 'url: {}'.format(
+            url))
 
     def get_entity(self, kwargs, is_put):
         raise NotImplementedError  # override this!
@@ -743,12 +879,28 @@ class UploadableResource(restful.Resource):
         entity = self.get_entity(kwargs, False)
         for ext in self.ALLOWED:
             f = self.file_for(entity, ext)
-            if os.path.exists(f):
-                self.found(entity, ext)
+            try:
+                stat = os.stat(f)
+            except OSError:  # no such file
+                continue
+            self.found(entity, ext)
+            if current_app.debug:
+                # there is no nginx in debug mode
+                response = send_file(f, conditional=True)
+            else:
                 response = make_response()
                 response.headers['X-Accel-Redirect'] = self.url_for(entity, ext)
                 response.headers['Content-Type'] = ''  # autodetect by nginx
-                return response
+            # allow clients to revalidate with If-None-Match/If-Modified-Since
+            response.set_etag('{}-{}'.format(int(stat.st_mtime), stat.st_size),
+                              weak=True)
+            response.last_modified = stat.st_mtime
+            if self.PUBLIC:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True
+            response.cache_control.max_age = self.CACHE_TIMEOUT
+            return response.make_conditional(request)
         else:
             self.notfound(entity)
             return (None, 204)  # HTTP code 204 NO CONTENT
@@ -760,6 +912,7 @@ class UploadableResource(restful.Resource):
             abort('[{}]: please provide file!'.format(self.PARAM))
 
         self.upload(f, entity)
+        db.session.commit()
 
         return dict(success=True)
 
@@ -767,8 +920,10 @@ class UploadableResource(restful.Resource):
         return self.put(*args, **kwargs)
 
     def delete(self, **kwargs):
+        deleted = self.delfile(self.get_entity(kwargs, True))
+        db.session.commit()
         return dict(
-            deleted=self.delfile(self.get_entity(kwargs, True)),
+            deleted=deleted,
         )
 
 
@@ -777,6 +932,8 @@ class UserpicResource(UploadableResource):
     PARAM = 'userpic'
     SUBDIR = 'userpics'
     ALLOWED = ['png']
+    MAX_IMAGE_SIZE = 256
+    FLAG = 'has_userpic'
 
     @require_auth
     def get_entity(self, args, is_put, user):
@@ -809,9 +966,10 @@ def balance_history(user):
         abort('[results_per_page]: max is 50')
 
     query = user.transactions
-    total_count = query.count()
-    query = query.paginate(args.page, args.results_per_page,
-                           error_out=False).items
+    total_count = fast_count(query)  # plain COUNT without subquery
+    # not using paginate() as it would count items once again
+    query = query.limit(args.results_per_page).offset(
+        max(args.page - 1, 0) * args.results_per_page).all()
 
     return jsonify(
         transactions=fields.List(fields.Nested(dict(
@@ -846,6 +1004,14 @@ def balance_deposit(user):
         ),
     )
 
+    payment = None
+    if not args.dry_run and args.payment_id:
+        # fetch payment while we are waiting for exchange rate
+        payment = eventlet.spawn(
+            copy_current_request_context(PayPal.call),
+            'GET', 'payments/payment/' + args.payment_id,
+        )
+
     rate = Fixer.latest(args.currency, 'USD')
     if not rate:
         abort('[currency]: Unknown currency {}'.format(args.currency),
@@ -856,7 +1022,7 @@ def balance_deposit(user):
         if not args.payment_id:
             abort('[payment_id]: required unless dry_run is true')
         # verify payment...
-        ret = PayPal.call('GET', 'payments/payment/' + args.payment_id)
+        ret = payment.wait()
         if ret.get('state') != 'approved':
             abort('Payment not approved: {} - {}'.format(
                 ret.get('name', '(no error code)'),
@@ -1032,6 +1198,19 @@ def balance_withdraw(user):
 
 
 _gamedata_cache = None
+GAMETYPES_CACHE_TTL = 30  # seconds
+_LINE_EDGES = re.compile(r'[ \t]*\n[ \t]*')
+_SINGLE_NL = re.compile(r'(?<!\n)\n(?!\n)')
+_MULTI_NL = re.compile(r'\n{2,}')
+def format_description(text):
+    """
+    Strips enclosing whites and indentation,
+    then replaces single \\n's with spaces
+    and double \\n's with single \\n's.
+    """
+    text = _LINE_EDGES.sub('\n', text.strip())
+    return _MULTI_NL.sub('\n', _SINGLE_NL.sub(' ', text))
+
 # Game types
 @app.route('/gametypes', methods=['GET'])
 def gametypes():
@@ -1048,6 +1227,20 @@ def gametypes():
     if args.filter:
         args.identities = False
 
+    # Whole response depends only on arguments (and slowly changing stats),
+    # so it is cached for a short time
+    cache_key = '{}.gametypes.{}'.format(
+        'test' if config.TEST else 'prod',
+        ':'.join('{}={}'.format(k, args[k]) for k in sorted(args)),
+    )
+    try:
+        cached = redis.get(cache_key)
+    except Exception:
+        log.exception('Failed to read gametypes cache')
+        cached = None
+    if cached:
+        return current_app.response_class(cached, mimetype='application/json')
+
     counts = {}
     if args.betcount:
         bca = (db.session.query(Game.gametype,
@@ -1067,56 +1260,52 @@ def gametypes():
 
     global _gamedata_cache
     if _gamedata_cache:
-        gamedata = _gamedata_cache.copy()
+        gamedata = _gamedata_cache
     else:
         gamedata = []
         for poller in Poller.allPollers():
             if poller is TestPoller:
                 continue
+            # fields which depend only on the poller are built once
+            if poller.identity or poller.twitch_identity or poller.honesty:
+                common = dict(
+                    supported=True,
+                    gamemodes=poller.gamemodes,
+                    identity=poller.identity_id,
+                    identity_name=poller.identity_name,
+                    honesty_only=poller.honesty,
+                    twitch=poller.twitch,
+                    twitch_identity=(poller.twitch_identity.id
+                                     if poller.twitch_identity else None),
+                    twitch_identity_name=(poller.twitch_identity.name
+                                          if poller.twitch_identity else None),
+                )
+            else:  # DummyPoller
+                common = dict(
+                    supported=False,
+                )
+            subtitle, category, description = (
+                poller.subtitle, poller.category, poller.description)
             for gametype, gametype_name in poller.gametypes.items():
                 _getsub = lambda f: f.get(gametype) if isinstance(f, dict) else f
-                data = dict(
+                text = _getsub(description)
+                gamedata.append(dict(
+                    common,
                     id=gametype,
                     name=gametype_name,
-                    subtitle=_getsub(poller.subtitle),
-                    category=_getsub(poller.category),
-                    description=_getsub(poller.description),
-                )
-                if data['description']:
-                    # strip enclosing whites,
-                    # then replace single \n's with spaces
-                    # and double \n's with single \n's
-                    data['description'] = '\n'.join(map(
-                        lambda para: ' '.join(map(
-                            lambda line: line.strip(),
-                            para.split('\n')
-                        )),
-                        data['description'].strip().split('\n\n')
-                    ))
-                if poller.identity or poller.twitch_identity or poller.honesty:
-                    data.update(dict(
-                        supported=True,
-                        gamemodes=poller.gamemodes,
-                        identity=poller.identity_id,
-                        identity_name=poller.identity_name,
-                        honesty_only=poller.honesty,
-                        twitch=poller.twitch,
-                        twitch_identity=None,  # may be updated below
-                        twitch_identity_name=None,
-                    ))
-                    if poller.twitch_identity:
-                        data['twitch_identity'] = poller.twitch_identity.id
-                        data['twitch_identity_name'] = poller.twitch_identity.name
-                else:  # DummyPoller
-                    data.update(dict(
-                        supported=False,
-                    ))
-                gamedata.append(data)
-        _gamedata_cache = gamedata.copy()
+                    subtitle=_getsub(subtitle),
+                    category=_getsub(category),
+                    description=format_description(text) if text else text,
+                ))
+        _gamedata_cache = gamedata
     if args.betcount:
-        for data in gamedata:
+        # copy items, as cached ones should stay intact
+        def with_counts(data):
+            data = dict(data)
             data['betcount'], data['lastbet'] = \
                 counts.get(data['id'], (0, None))
+            return data
+        gamedata = list(map(with_counts, gamedata))
     if args.filter:
         args.filter = args.filter.casefold()
         if args.filt_op == 'contains':
@@ -1148,7 +1337,27 @@ def gametypes():
                 date=date,
             ) for gametype, date in times
         ]
-    return jsonify(**ret)
+    response = jsonify(**ret)
+    try:
+        redis.set(cache_key, response.get_data(), ex=GAMETYPES_CACHE_TTL)
+    except Exception:
+        log.exception('Failed to write gametypes cache')
+    return response
+
+
+# filter for resizing gametype images
+RESAMPLE_FILTER = Image.LANCZOS
+# cheaper filter for strong (more than 2x) downscaling,
+# where Lanczos costs most but looks the same
+DOWNSCALE_FILTER = Image.BICUBIC
+# how long clients may use resized images without revalidation, in seconds
+IMAGE_CACHE_TIMEOUT = 86400
+# upper bound for requested width/height, as every size gets its own
+# cached file and is allocated in memory while resizing
+IMAGE_MAX_DIMENSION = 1024
+# zlib level for resized images; they are encoded while client waits,
+# and default level costs much more time than it saves in size
+PNG_COMPRESS_LEVEL = 1
 
 
 @app.route('/gametypes/<id>/image')
@@ -1161,44 +1370,116 @@ def gametype_image(id):
     parser.add_argument('w', type=int, required=False)
     parser.add_argument('h', type=int, required=False)
     args = parser.parse_args()
+    for dim in 'w', 'h':
+        if args[dim] is not None:
+            if args[dim] <= 0:
+                abort('[{}]: should be positive'.format(dim), problem=dim)
+            args[dim] = min(args[dim], IMAGE_MAX_DIMENSION)
 
+    background = request.path.endswith('/background')
     filename = 'images/{}{}.png'.format(
-        'bg/' if request.path.endswith('/background') else '',
+        'bg/' if background else '',
         id,
     )
     try:
-        img = Image.open(filename)
+        mtime = os.path.getmtime(filename)
     except FileNotFoundError:
         raise NotFound  # 404
+
+    if not (args.w or args.h):
+        # nothing to convert, so send the file as is
+        if current_app.debug or not config.NGINX_IMAGES:
+            return send_file(filename, mimetype='image/png', conditional=True)
+        # let nginx send it, see README for required location
+        response = make_response()
+        response.headers['X-Accel-Redirect'] = '/_' + filename
+        response.headers['Content-Type'] = 'image/png'
+        return response
+
+    def conditional(response):
+        # resized image depends only on original's mtime and requested size
+        response.set_etag('{}-{}x{}'.format(
+            int(mtime), args.w or '', args.h or ''), weak=True)
+        response.last_modified = mtime
+        response.cache_control.public = True
+        response.cache_control.max_age = IMAGE_CACHE_TIMEOUT
+        return response.make_conditional(request)
+
+    # revalidating client needs neither resizing nor the cached copy
+    if request.if_none_match or request.if_modified_since:
+        response = conditional(current_app.response_class())
+        if response.status_code == 304:
+            return response
+
+    # Resized images are cached on disk;
+    # cached copy is valid unless original was changed after it was made.
+    cachename = 'images/cache/{}{}_{}x{}.png'.format(
+        'bg_' if background else '',
+        id,
+        args.w or '',
+        args.h or '',
+    )
+    try:
+        if os.path.getmtime(cachename) >= mtime:
+            return conditional(send_file(cachename, mimetype='image/png'))
+    except FileNotFoundError:
+        pass
+
+    img = Image.open(filename)
     ow, oh = img.size
-    if args.w or args.h:
-        if not args.h or (args.w and args.h and (args.w / args.h) > (ow / oh)):
-            dw = args.w
-            dh = round(oh / ow * dw)
-        else:
-            dh = args.h
-            dw = round(ow / oh * dh)
-
-        # resize
-        img = img.resize((dw, dh), Image.ANTIALIAS)
-
-        # crop if needed
-        if args.w and args.h:
-            if args.w != dw:
-                # crop horizontally
-                cw = (dw - args.w) / 2
-                cl, cr = math.floor(cw), math.ceil(cw)
-                img = img.crop(box=(cl, 0, img.width - cr, img.height))
-            elif args.h != dh:
-                # crop vertically
-                ch = (dh - args.h) / 2
-                cu, cd = math.floor(ch), math.ceil(ch)
-                img = img.crop(box=(0, cu, img.width, img.height - cd))
+    if not args.h or (args.w and args.h and (args.w / args.h) > (ow / oh)):
+        dw = args.w
+        dh = round(oh / ow * dw)
+    else:
+        dh = args.h
+        dw = round(ow / oh * dh)
+
+    # Crop if needed. Crop box is given in source image coordinates
+    # so that cropping is done by resize itself, in the same pass.
+    tw, th = dw, dh
+    box = (0, 0, ow, oh)
+    if args.w and args.h:
+        if args.w != dw:
+            # crop horizontally
+            cw = (dw - args.w) / 2
+            cl, cr = math.floor(cw), math.ceil(cw)
+            tw = dw - cl - cr
+            box = (cl * ow / dw, 0, ow - cr * ow / dw, oh)
+        elif args.h != dh:
+            # crop vertically
+            ch = (dh - args.h) / 2
+            cu, cd = math.floor(ch), math.ceil(ch)
+            th = dh - cu - cd
+            box = (0, cu * oh / dh, ow, oh - cd * oh / dh)
+
+    # resize
+    img = img.resize(
+        (tw, th),
+        DOWNSCALE_FILTER if dw * 2 < ow else RESAMPLE_FILTER,
+        box=box,
+    )
 
     img_file = BytesIO()
-    img.save(img_file, 'png')
+    img.save(img_file, 'png', compress_level=PNG_COMPRESS_LEVEL)
+
+    # write to temporary file and then rename it,
+    # so that concurrent requests never see partially written file
+    os.makedirs(os.path.dirname(cachename), exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(cachename),
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(img_file.getbuffer())
+        os.replace(tmpname, cachename)
+    except OSError:
+        log.exception('Failed to cache image '+cachename)
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+
     img_file.seek(0)
-    return send_file(img_file, mimetype='image/png')
+    return conditional(send_file(img_file, mimetype='image/png'))
 
 
 @app.route('/identities', methods=['GET'])
@@ -1215,6 +1496,12 @@ def identities():
     )
 
 
+def _region(identity):
+    # region is the part of identity before the first slash, if any
+    idx = identity.find('/')
+    return identity if idx < 0 else identity[:idx]
+
+
 # Games
 @api.resource(
     '/games',
@@ -1222,12 +1509,19 @@ def identities():
     '/games/<int:id>',
 )
 class GameResource(restful.Resource):
+    ORDERS = order_choices(
+        'create_date', 'accept_date', 'gametype', 'creator_id', 'opponent_id',
+    )
+
     @classproperty
     def fields_lite(cls):
-        return {
+        # one instance is shared by all player fields
+        player = fields.Nested(field_instances(
+            PlayerResource.fields(public=True)))
+        return field_instances({
             'id': fields.Integer,
-            'creator': fields.Nested(PlayerResource.fields(public=True)),
-            'opponent': fields.Nested(PlayerResource.fields(public=True)),
+            'creator': player,
+            'opponent': player,
             'parent_id': fields.Integer,
             'is_root': fields.Boolean,
             'gamertag_creator': fields.String(attribute='gamertag_creator_text'),
@@ -1247,13 +1541,12 @@ class GameResource(restful.Resource):
             'create_date': fields.DateTime,
             'state': fields.String,
             'accept_date': fields.DateTime,
-            'aborter': fields.Nested(PlayerResource.fields(public=True),
-                                     allow_null=True),
+            'aborter': fields.Nested(player.nested, allow_null=True),
             'winner': fields.String,
             'details': fields.String,
             'finish_date': fields.DateTime,
             'tournament_id': fields.Integer,
-        }
+        })
 
     @classproperty
     def fields(cls):
@@ -1263,6 +1556,10 @@ class GameResource(restful.Resource):
         })
         return ret
 
+    @classproperty
+    def fields_list(cls):
+        return fields.List(fields.Nested(cls.fields))
+
     @require_auth
     def get(self, user, id=None):
         if id:
@@ -1274,23 +1571,7 @@ class GameResource(restful.Resource):
 
             return marshal(game, self.fields)
 
-        parser = RequestParser()
-        parser.add_argument('page', type=int, default=1)
-        parser.add_argument('results_per_page', type=int, default=10)
-        parser.add_argument(
-            'order',
-            choices=sum(
-                [[s, '-' + s]
-                 for s in
-                 ('create_date',
-                  'accept_date',
-                  'gametype',
-                  'creator_id',
-                  'opponent_id',
-                  )], []),
-            required=False,
-        )
-        args = parser.parse_args()
+        args = self.listparser.parse_args()
         # cap
         if args.results_per_page > 50:
             abort('[results_per_page]: max is 50')
@@ -1298,6 +1579,19 @@ class GameResource(restful.Resource):
         query = user.games
 
         # TODO: filters
+        total_count = fast_count(query)  # plain COUNT without subquery
+
+        # load players (and children with their players) for the whole page
+        # at once instead of lazily for every serialized game
+        query = query.options(
+            joinedload(Game.creator),
+            joinedload(Game.opponent),
+            joinedload(Game.aborter),
+            subqueryload(Game.children).joinedload(Game.creator),
+            subqueryload(Game.children).joinedload(Game.opponent),
+            subqueryload(Game.children).joinedload(Game.aborter),
+        )
+
         if args.order:
             if args.order.startswith('-'):
                 order = getattr(Game, args.order[1:]).desc()
@@ -1305,17 +1599,29 @@ class GameResource(restful.Resource):
                 order = getattr(Game, args.order).asc()
             query = query.order_by(order)
 
-        total_count = query.count()
-        query = query.paginate(args.page, args.results_per_page,
-                               error_out=False)
+        # not using paginate() as it would count items once again
+        query = query.limit(args.results_per_page).offset(
+            max(args.page - 1, 0) * args.results_per_page).all()
 
         return dict(
-            games=fields.List(fields.Nested(self.fields)).format(query.items),
+            games=self.fields_list.format(query),
             num_results=total_count,
             total_pages=math.ceil(total_count / args.results_per_page),
             page=args.page,
         )
 
+    @classproperty
+    def listparser(cls):
+        parser = RequestParser()
+        parser.add_argument('page', type=int, default=1)
+        parser.add_argument('results_per_page', type=int, default=10)
+        parser.add_argument(
+            'order',
+            choices=cls.ORDERS,
+            required=False,
+        )
+        return parser
+
     @classproperty
     def postparser(cls):
         parser = RequestParser()
@@ -1444,8 +1750,8 @@ class GameResource(restful.Resource):
             # opponent identity not passed - cannot check
             return
         # this is an additional check for regions
-        region1 = crea.split('/', 1)[0]
-        region2 = oppo.split('/', 1)[0]
+        region1 = _region(crea)
+        region2 = _region(oppo)
         if region1 != region2:
             abort('You and your opponent should be in the same region; '
                     'but actually you are in {} and your opponent is in {}'.format(
@@ -1532,34 +1838,42 @@ class GameResource(restful.Resource):
             game.bet = args.bet
 
         db.session.add(game)
+        db.session.flush()
+        # serialize before commit expires the game, to avoid reloading it
+        ret = marshal(game, self.fields)
         db.session.commit()
 
         log.debug('notifying')
         notify_users(game)
 
-        return marshal(game, self.fields), 201
-
-    def patch(self, id=None):
-        if not id:
-            raise MethodNotAllowed
+        return ret, 201
 
+    @classproperty
+    def patchparser(cls):
         parser = RequestParser()
         parser.add_argument('state', choices=[
             'accepted', 'declined', 'cancelled'
         ], required=True)
         parser.add_argument('gamertag_opponent', required=False)
         parser.add_argument('twitch_identity_opponent', required=False)
-        args = parser.parse_args()
+        return parser
+
+    def patch(self, id=None):
+        if not id:
+            raise MethodNotAllowed
+
+        args = self.patchparser.parse_args()
 
         game = Game.query.get_or_404(id)
 
         user = check_auth()
-        if user == game.creator:
+        # compare ids so that players are not loaded just for this check
+        if user.id == game.creator_id:
             if args.state not in ['cancelled']:
                 abort('Only {} can accept or decline this challenge'.format(
                     game.opponent.nickname,
                 ))
-        elif user == game.opponent:
+        elif user.id == game.opponent_id:
             if args.state not in ['accepted', 'declined']:
                 abort('Only {} can cancel this challenge'.format(
                     game.creator.nickname,
@@ -1616,7 +1930,9 @@ class GameResource(restful.Resource):
         # so that we can abort request if it failed
         if game.twitch_handle and args.state == 'accepted':
             try:
-                ret = requests.put(
+                # shared session keeps connection to observer alive;
+                # timeout so that stalled observer doesn't hold the worker
+                ret = http_session.put(
                     '{}/streams/{}/{}'.format(
                         config.OBSERVER_URL,
                         game.twitch_handle,
@@ -1631,6 +1947,7 @@ class GameResource(restful.Resource):
                         if poller.twitch_identity else
                         game.gamertag_opponent,
                     ),
+                    timeout=10,
                 )
             except Exception:
                 log.exception('Failed to start twitch stream!')
@@ -1840,6 +2157,7 @@ class GameMessageResource(UploadableResource):
     PARAM = 'msg'
     SUBDIR = 'messages'
     ALLOWED = ['mpg', 'mp3', 'ogg', 'ogv', 'mp4', 'm4a']
+    FLAG = 'has_message'
 
     @require_auth
     def get_entity(self, args, is_put, user):
@@ -1867,6 +2185,8 @@ class GameMessageResource(UploadableResource):
     '/messages/<int:id>'
 )
 class ChatMessageResource(restful.Resource):
+    ORDERS = order_choices('time')
+
     @classproperty
     def fields(cls):
         return dict(
@@ -1937,11 +2257,7 @@ class ChatMessageResource(restful.Resource):
         parser.add_argument('results_per_page', type=int, default=10)
         parser.add_argument(
             'order', default='time',
-            choices=sum(
-                [[s, '-' + s]
-                 for s in (
-                    'time',
-                )], []),
+            choices=self.ORDERS,
         )
         args = parser.parse_args()
         if args.results_per_page > 50:
@@ -2050,6 +2366,7 @@ class ChatMessageAttachmentResource(UploadableResource):
     PARAM = 'attachment'
     SUBDIR = 'attachments'
     ALLOWED = ['mp4', 'm4a', 'mov', 'png', 'jpg']
+    FLAG = 'has_attachment'
 
     @require_auth
     def get_entity(self, args, is_put, user):
@@ -2080,21 +2397,6 @@ class ChatMessageAttachmentResource(UploadableResource):
             raise ValueError('no ids')
         return msg
 
-    @classmethod
-    def onupload(cls, entity, ext):
-        if not entity.has_attachment:
-            entity.has_attachment = True
-            db.session.commit()
-
-    @classmethod
-    def ondelete(cls, entity):
-        if entity.has_attachment:
-            entity.has_attachment = False
-            db.session.commit()
-
-    found = onupload
-    notfound = ondelete
-
 
 # Events
 @api.resource(
@@ -2152,7 +2454,7 @@ class EventResource(restful.Resource):
 class BetaResource(restful.Resource):
     @classproperty
     def fields(cls):
-        return dict(
+        return field_instances(dict(
             id=fields.Integer,
             email=fields.String,
             name=fields.String,
@@ -2161,7 +2463,7 @@ class BetaResource(restful.Resource):
             console=CommaListField,
             create_date=fields.DateTime,
             flags=JsonField,
-        )
+        ))
 
     @require_auth
     def get(self, user, id=None):
@@ -2173,7 +2475,7 @@ class BetaResource(restful.Resource):
 
         return jsonify(
             betatesters=fields.List(fields.Nested(self.fields)).format(
-                Beta.query,
+                Beta.query.yield_per(200),
             ),
         )
 
@@ -2234,25 +2536,35 @@ class BetaResource(restful.Resource):
         log.info('flags for {}: {}'.format(beta.id, beta.flags))
         # and create backup for flags
         def merge(src, dst):
-            for k, v in src.items():
-                if isinstance(v, dict):
-                    node = dst.setdefault(k, {})
-                    merge(v, node)
-                elif isinstance(v, list):
-                    dst.setdefault(k, [])
-                    dst[k] = list(set(dst[k] + v))  # merge items
-                else:
-                    dst[k] = v
+            # iterative, so that deeply nested flags don't hit recursion limit
+            stack = [(src, dst)]
+            while stack:
+                s, d = stack.pop()
+                for k, v in s.items():
+                    if isinstance(v, dict):
+                        stack.append((v, d.setdefault(k, {})))
+                    elif isinstance(v, list):
+                        # merge items, appending only new ones in place
+                        bucket = d.setdefault(k, [])
+                        seen = set(bucket)
+                        for item in v:
+                            if item not in seen:
+                                seen.add(item)
+                                bucket.append(item)
+                    else:
+                        d[k] = v
             return dst
 
         try:
             src = json.loads(beta.flags)
-            try:
-                dst = json.loads(beta.backup or '')
-            except ValueError:
-                dst = {}
+            dst = {}
+            if beta.backup:
+                try:
+                    dst = json.loads(beta.backup)
+                except ValueError:
+                    pass
             merge(src, dst)
-            beta.backup = json.dumps(dst)
+            beta.backup = json.dumps(dst, separators=(',', ':'))
         except ValueError:
             pass
 
@@ -2326,6 +2638,8 @@ def socketio_disconn():
     '/tournaments/<int:id>/',
 )
 class TournamentResource(restful.Resource):
+    ORDERS = order_choices('id', 'open_date', 'start_date', 'finish_date')
+
     participant_fields = {
         'player': fields.Nested(PlayerResource.fields(), allow_null=True),
         'round': fields.Integer,
@@ -2430,16 +2744,7 @@ class TournamentResource(restful.Resource):
         parser = RequestParser()
         parser.add_argument('page', type=int, default=1)
         parser.add_argument('results_per_page', type=int, default=10)
-        parser.add_argument('order', default='id', choices=sum([
-            [s, '-' + s]
-            for s in (
-                'id',
-                'open_date',
-                'start_date',
-                'finish_date',
-            )
-            ], [])
-        )
+        parser.add_argument('order', default='id', choices=self.ORDERS)
         args = parser.parse_args()
         # cap
         if args.results_per_page > 50:
@@ -2472,10 +2777,13 @@ class TournamentResource(restful.Resource):
 
 
 # Debugging-related endpoints
+_GAME_STATES = frozenset(Game.state.prop.columns[0].type.enums)
+
+
 @app.route('/debug/push_state/<state>', methods=['POST'])
 @require_auth
 def push_state(state, user):
-    if state not in Game.state.prop.columns[0].type.enums:
+    if state not in _GAME_STATES:
         abort('Unknown state ' + state, 404)
 
     parser = GameResource.postparser.copy()